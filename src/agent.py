@@ -99,7 +99,9 @@ picsellia_ai_hr_workforce = CodeAgent(
 #     """
 # )
 
-picsellia_ai_hr_workforce.run(
-    "find outliers in DatasetVersion 01944abb-2724-732c-bdac-19d8f94088ec"
-)
+# Guarded so that the worker processes of the sharded detector can import this module without running the agent
+if __name__ == "__main__":
+    picsellia_ai_hr_workforce.run(
+        "find outliers in DatasetVersion 01944abb-2724-732c-bdac-19d8f94088ec"
+    )
  
\ No newline at end of file
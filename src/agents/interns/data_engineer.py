@@ -16,7 +16,8 @@ from smolagents import CodeAgent, HfApiModel, LiteLLMModel, DuckDuckGoSearchTool
 from tools.dataset.read import list_dataset_assets_tool, list_dataset_labels_tool, fetch_dataset_version_by_id_tool, dataset_version_repartition_viewer,check_if_label_exists, fetch_dataset_version_by_name_and_version
 from tools.dataset.init import set_inference_type_tool, picsellia_connection_tool
 from tools.dataset.create import create_picsellia_label_object, create_train_test_val_dataset_version
-from tools.predictors import zero_shot_object_detector 
+from tools.dataset.duplicates import near_duplicate_detector
+from tools.predictors import zero_shot_object_detector, zero_shot_dataset_version_detector
 from tools.datalake.create import create_dataset_and_version_tool
 from tools.datalake.search import list_data_in_datalake_through_tags, list_all_datasets_and_dataset_versions_tool
 from tools.datalake.initializers import intialize_datalake_tool
@@ -84,7 +85,7 @@ dataset_toolset = [
     dataset_version_repartition_viewer, check_if_label_exists, 
     set_inference_type_tool, picsellia_connection_tool,
     create_picsellia_label_object, create_train_test_val_dataset_version,
-    zero_shot_object_detector
+    zero_shot_object_detector, zero_shot_dataset_version_detector, near_duplicate_detector
 ]
 
 toolset = datalake_toolset + dataset_toolset
@@ -5,8 +5,6 @@ import picsellia.types.schemas
 from picsellia import Label, Asset
 import requests
 from PIL import Image
-import torch
-from transformers import Owlv2Processor, Owlv2ForObjectDetection
 from typing import List, Generator
 import time 
 from smolagents import tools, Tool, ManagedAgent
@@ -17,6 +15,7 @@ from tools.dataset.read import list_dataset_assets_tool, list_dataset_labels_too
 from tools.dataset.init import set_inference_type_tool, picsellia_connection_tool
 from tools.dataset.create import create_train_test_val_dataset_version
 from tools.dataset.analyze import dataset_version_outliers_detector, asset_tagger
+from tools.dataset.duplicates import near_duplicate_detector
 from tools.project.write import create_picsellia_project, attach_dataset_to_project
 from tools.project.read import get_project_by_name
 from tools.experiment.write import create_picsellia_experiment
@@ -94,7 +93,8 @@ dataset_toolset = [
     list_dataset_assets_tool, list_dataset_labels_tool, fetch_dataset_version_by_id_tool,
     check_if_label_exists, 
     set_inference_type_tool, picsellia_connection_tool,
-    create_train_test_val_dataset_version, dataset_version_outliers_detector, asset_tagger
+    create_train_test_val_dataset_version, dataset_version_outliers_detector, asset_tagger,
+    near_duplicate_detector
 ]
 
 project_tool_set = [
@@ -0,0 +1,61 @@
+"""
+Startup benchmark: time and peak memory of importing the agents, each measured in a fresh process.
+
+`--load-clip` also loads the model of the outlier detector right after the import, which is what
+importing `tools.dataset.analyze` used to do, to compare the startup cost before and after lazy loading.
+
+Run from `src/`:
+    python -m benchmarks.agent_startup
+    python -m benchmarks.agent_startup --load-clip
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+MODULES = ["tools.dataset.analyze", "tools.predictors", "agents.interns.data_scientist", "agents.interns.data_engineer"]
+
+MEASURE = """
+import json, resource, sys, time
+start = time.perf_counter()
+__import__({module!r})
+if {load_clip!r}:
+    from tools.dataset.analyze import dataset_version_outliers_detector
+    dataset_version_outliers_detector.load_model()
+seconds = time.perf_counter() - start
+max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+# Kilobytes on Linux, bytes on macOS
+max_rss_mb = max_rss / 1024 ** 2 if sys.platform == "darwin" else max_rss / 1024
+print(json.dumps({{"seconds": seconds, "max_rss_mb": max_rss_mb}}))
+"""
+
+
+def measure(module: str, load_clip: bool) -> dict:
+    completed = subprocess.run(
+        [sys.executable, "-c", MEASURE.format(module=module, load_clip=load_clip)], capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        return {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "failed"}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=MODULES)
+    parser.add_argument("--load-clip", action="store_true", help="Also load the CLIP model, as the eager tool did")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        runs = [measure(module, args.load_clip) for _ in range(args.repeats)]
+        errors = [run["error"] for run in runs if "error" in run]
+        if errors:
+            print(f"{module}: {errors[0]}")
+            continue
+        seconds = sorted(run["seconds"] for run in runs)[len(runs) // 2]
+        max_rss_mb = max(run["max_rss_mb"] for run in runs)
+        print(f"{module}: {seconds:.2f} s (median), {max_rss_mb:.0f} MB peak RSS")
+
+
+if __name__ == "__main__":
+    main()
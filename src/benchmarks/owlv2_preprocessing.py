@@ -0,0 +1,68 @@
+"""
+Micro-benchmark of the OWLv2 preprocessing: Hugging Face processor vs `utils.preprocessing.owlv2_preprocess`.
+
+Run from `src/`:
+    python -m benchmarks.owlv2_preprocessing
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import Owlv2Processor
+
+from utils.preprocessing import compare_with_processor, owlv2_preprocess
+
+IMAGE_SIZES = [(4032, 3024), (1920, 1080), (1024, 1024), (640, 480)]
+
+
+def random_images(sizes, seed: int = 0):
+    # Smooth random images, closer to photos than white noise for the antialiasing filters
+    rng = np.random.default_rng(seed)
+    images = []
+    for width, height in sizes:
+        small = rng.integers(0, 256, size=(height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+        images.append(Image.fromarray(small).resize((width, height), Image.BILINEAR))
+    return images
+
+
+def time_per_image(preprocess, images, repeats: int) -> float:
+    preprocess(images)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        preprocess(images)
+    return (time.perf_counter() - start) / (repeats * len(images))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model-id", default="google/owlv2-base-patch16-ensemble")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--pad-value", type=float, default=0.5,
+                        help="Padding of the processor under test, 0.0 with transformers 5.x")
+    args = parser.parse_args()
+
+    processor = Owlv2Processor.from_pretrained(args.model_id)
+    image_processor = processor.image_processor
+    size = image_processor.size["height"]
+    print(f"torch {torch.__version__}, {torch.get_num_threads()} threads, {size}x{size} inputs")
+
+    for image_size in IMAGE_SIZES:
+        images = random_images([image_size] * 4)
+        hf_seconds = time_per_image(lambda batch: processor(images=batch, return_tensors="pt"), images, args.repeats)
+        fast_seconds = time_per_image(
+            lambda batch: owlv2_preprocess(batch, size=size, mean=image_processor.image_mean, std=image_processor.image_std,
+                                    pad_value=args.pad_value),
+            images, args.repeats,
+        )
+        parity = compare_with_processor(images[:1], processor, pad_value=args.pad_value)
+        print(
+            f"{image_size[0]}x{image_size[1]}: hf {hf_seconds * 1000:.1f} ms/image, "
+            f"torch {fast_seconds * 1000:.1f} ms/image ({hf_seconds / fast_seconds:.1f}x), "
+            f"max abs diff {parity['max_abs_diff']:.4f}, mean abs diff {parity['mean_abs_diff']:.5f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
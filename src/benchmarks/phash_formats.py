@@ -0,0 +1,68 @@
+"""
+Checks that perceptual hashes do not depend on the image format: the JPEG and PNG copies of the same
+images must hash at most `--max-bits` apart, and reports the hashing throughput of both formats.
+
+Run from `src/`:
+    python -m benchmarks.phash_formats
+"""
+import argparse
+import io
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from utils.phash import HASH_METHODS, hamming_distances, hash_image_bytes
+
+
+def smooth_images(count: int, size: tuple, seed: int = 0):
+    # Smooth random images, closer to photos than white noise, with sizes not multiple of the reduction factors
+    rng = np.random.default_rng(seed)
+    width, height = size
+    for _ in range(count):
+        small = rng.integers(0, 256, size=(height // 100 + 2, width // 100 + 2, 3), dtype=np.uint8)
+        yield Image.fromarray(small).resize((width, height), Image.BICUBIC)
+
+
+def encode(image: Image.Image, format: str, **params) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format, **params)
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=30)
+    parser.add_argument("--width", type=int, default=2000)
+    parser.add_argument("--height", type=int, default=1500)
+    parser.add_argument("--quality", type=int, default=90, help="JPEG quality")
+    parser.add_argument("--max-bits", type=int, default=2)
+    args = parser.parse_args()
+
+    pairs = [(encode(image, "JPEG", quality=args.quality), encode(image, "PNG"))
+             for image in smooth_images(args.count, (args.width, args.height))]
+    failed = False
+    for method in HASH_METHODS:
+        seconds = {"JPEG": 0.0, "PNG": 0.0}
+        distances = []
+        for jpeg, png in pairs:
+            start = time.perf_counter()
+            jpeg_hash = hash_image_bytes(jpeg, method)
+            seconds["JPEG"] += time.perf_counter() - start
+            start = time.perf_counter()
+            png_hash = hash_image_bytes(png, method)
+            seconds["PNG"] += time.perf_counter() - start
+            distances.append(int(hamming_distances(jpeg_hash, png_hash)))
+
+        failed |= max(distances) > args.max_bits
+        throughput = ", ".join(f"{format} {60 * len(pairs) / total:.0f} images/min" for format, total in seconds.items())
+        print(f"{method}: JPEG vs PNG distances {sorted(distances)}, max {max(distances)} ({throughput})")
+
+    if failed:
+        print(f"Some JPEG and PNG copies hash more than {args.max_bits} bits apart.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,30 @@
 import numpy as np
 from PIL import Image
-import requests
 import torch
-from sklearn.cluster import DBSCAN
 from picsellia import Client, Asset
 from picsellia.exceptions import ResourceNotFoundError
 from smolagents import Tool
 import torch
-from PIL import Image
-import requests
-from transformers import CLIPProcessor, CLIPModel
-from typing import List 
+from concurrent.futures import Future
+from typing import Iterable, Iterator, List, Optional
 import logging
+import os
 from picsellia.sdk.asset import MultiAsset
+from utils.ann import FaissIndex, create_index, load_index
+from utils.batching import inference_service
+from utils.embedding_store import EmbeddingStore
+from utils.image_cache import fetch_asset_bytes
+from utils.images import decode_image
+from utils.journal import config_fingerprint
+from utils.models import model_registry, select_device, select_dtype
+from utils.outliers import OUTLIER_METHODS, outlier_scores, outlier_threshold, parse_contamination
+from utils.pipeline import PipelineStats, batched, prefetch
+from utils.streaming_stats import StreamingOutlierScorer
+
+# Smaller backbones, e.g. openai/clip-vit-base-patch32, embed several times faster with less memory
+CLIP_MODEL_ID = os.getenv("CLIP_MODEL_ID", "openai/clip-vit-large-patch14")
+
+logger = logging.getLogger(__name__)
 
 class DatasetVersionEmbeddingTool(Tool):
     name = "dataset_version_outliers_detector"
@@ -26,34 +38,317 @@ class DatasetVersionEmbeddingTool(Tool):
             "type": "string",
             "description": "ID of the dataset version to analyze",
         },
+        "method": {
+            "type": "string",
+            "description": "Outlier score: `centroid` (distance to the mean image), `knn` (distance to the k-th most similar image) or `lof` (local outlier factor, also finds small groups of unusual images)",
+            "nullable": "True"
+        },
+        "contamination": {
+            "type": "any",
+            "description": "Expected fraction of outliers, e.g. 0.05, or `auto` to only flag the images whose score is far above the others",
+            "nullable": "True"
+        },
     }
     output_type = "object"
 
-    def __init__(self, **kwargs):
+    def __init__(self, model_id: str = CLIP_MODEL_ID, device: str = None,
+                 batch_size: int = int(os.getenv("CLIP_BATCH_SIZE", "32")), num_workers: int = 4,
+                 prefetch_batches: int = 2, dtype: str = os.getenv("CLIP_DTYPE", "auto"),
+                 embedding_store_dir: str = os.getenv(
+                     "CLIP_EMBEDDING_STORE_DIR", os.path.expanduser("~/.cache/cv-interns/embeddings")
+                 ), ann_backend: str = os.getenv("ANN_BACKEND", "auto"),
+                 streaming: bool = os.getenv("OUTLIER_STREAMING", "0") == "1",
+                 streaming_metric: str = os.getenv("OUTLIER_STREAMING_METRIC", "euclidean"),
+                 outlier_method: str = os.getenv("OUTLIER_METHOD", "centroid"),
+                 contamination: str = os.getenv("OUTLIER_CONTAMINATION", "0.15"),
+                 neighbours: int = int(os.getenv("OUTLIER_NEIGHBOURS", "10")), **kwargs):
         super().__init__(**kwargs)
-        model_name = "openai/clip-vit-large-patch14"
-        self.device = "mps" if torch.backends.mps.is_available() else "cpu"
-        self.model = CLIPModel.from_pretrained(model_name).to(self.device)
-        self.processor = CLIPProcessor.from_pretrained(model_name)
-        self.model.eval()
+        self.model_id = model_id
+        self.device = device
+        self.batch_size = batch_size
+        # Threads downloading, decoding and preprocessing the next batches while the model runs
+        self.num_workers = num_workers
+        self.prefetch_batches = prefetch_batches
+        # Weights dtype, see `utils.models.select_dtype`
+        self.dtype = dtype
+        # Embeddings are kept per DatasetVersion so that later runs only embed the new assets, disabled when empty
+        self.embedding_store_dir = embedding_store_dir
+        # Backend of `embedding_index`, see `utils.ann.create_index`
+        self.ann_backend = ann_backend
+        # Scores the embeddings as they are computed, in memory independent of the number of assets,
+        # see `iter_outlier_scores`
+        self.streaming = streaming
+        self.streaming_metric = streaming_metric
+        # Defaults of the `method` and `contamination` inputs, see `utils.outliers`
+        self.outlier_method = outlier_method
+        self.contamination = contamination
+        # Number of neighbours of the `knn` and `lof` scores
+        self.neighbours = neighbours
+
+    def load_model(self):
+        # Loaded on first use, not when the agents are built, and shared with the other tools
+        # through the registry, which may evict it between calls. Importing the CLIP classes alone
+        # takes seconds, so it is deferred too.
+        from transformers import CLIPModel, CLIPProcessor
+
+        dtype = select_dtype(self.dtype, select_device(self.device))
+        return model_registry.get(CLIPModel, CLIPProcessor, self.model_id, device=self.device, dtype=dtype)
     
+    def load_image(self, asset: Asset) -> Image.Image:
+        # CLIP resizes the shortest side, the image is decoded at the closest resolution above it
+        _, processor = self.load_model()
+        target_size = processor.image_processor.size["shortest_edge"]
+        return decode_image(fetch_asset_bytes(asset), target_size=target_size, fit="shortest")
+
+    def model_fingerprint(self) -> str:
+        """Identifies the embeddings of this tool, stored embeddings are recomputed when it changes."""
+        return config_fingerprint({"model_id": self.model_id, "dtype": self.dtype})
+
+    def embedding_store(self, dataset_version_id: str) -> EmbeddingStore:
+        if not self.embedding_store_dir:
+            return None
+        return EmbeddingStore(
+            os.path.join(self.embedding_store_dir, self.model_fingerprint()), dataset_version_id, self.model_fingerprint()
+        )
+
+    def preprocess(self, image: Image.Image) -> torch.Tensor:
+        """Returns the CLIP pixel values of one image (3 x H x W)."""
+        _, processor = self.load_model()
+        return processor(images=image, return_tensors="pt")["pixel_values"][0]
+
+    def load_input(self, asset: Asset) -> torch.Tensor:
+        return self.preprocess(self.load_image(asset))
+
+    def embed_pixels(self, pixel_values: torch.Tensor) -> np.ndarray:
+        """Returns the L2-normalized CLIP embeddings of a batch of pixel values, one float32 row per image."""
+        model, _ = self.load_model()
+        dtype = next(model.parameters()).dtype
+        with torch.inference_mode():
+            embeddings = model.get_image_features(pixel_values=pixel_values.to(model.device, dtype)).float()
+        embeddings = embeddings / embeddings.norm(dim=-1, keepdim=True)
+        return embeddings.cpu().numpy()
+
+    def submit_pixels(self, pixel_values: List[torch.Tensor]) -> List[Future]:
+        """
+        Queues the pixel values of images to the shared inference service and returns the futures of their
+        embeddings. Concurrent requests, e.g. from several agents, are embedded in batches of up to `batch_size`.
+        """
+        return inference_service.submit_many(
+            ("clip", id(self)), lambda batch: self.embed_pixels(torch.stack(batch)), pixel_values,
+            max_batch_size=self.batch_size,
+        )
+
+    def embed_images(self, images: List[Image.Image]) -> np.ndarray:
+        """Returns the L2-normalized CLIP embeddings of a batch of RGB images, one row per image."""
+        return self.embed_pixels(torch.stack([self.preprocess(image) for image in images]))
+
+    def load_embeddings(self, dataset_version) -> tuple:
+        """
+        Returns the `(assets, embeddings)` of the assets of `dataset_version` that could be embedded,
+        embeddings being a float32 matrix with one L2-normalized row per asset.
+
+        With an embedding store, only the assets added since the previous call are embedded.
+        """
+        assets = dataset_version.list_assets()
+        store = self.embedding_store(dataset_version.id)
+        # Only the assets added since the last run are embedded when the version has a store
+        to_embed = store.sync(assets) if store is not None else assets
+
+        embedded_assets, embeddings = [], []
+        stats = PipelineStats()
+        for asset, embedding, error in self.iter_embeddings(to_embed, stats=stats):
+            if error is not None:
+                logger.warning(f"Could not embed asset {asset.filename}: {error}")
+                continue
+            embedded_assets.append(asset)
+            embeddings.append(embedding)
+        logger.info(f"Embedded {len(embedded_assets)} of {len(assets)} assets: {stats.as_dict()}")
+
+        if store is not None:
+            store.add(embedded_assets, np.array(embeddings))
+            store.save()
+            assets, embeddings_array = store.get(assets)
+        else:
+            assets, embeddings_array = embedded_assets, np.array(embeddings)
+        return assets, embeddings_array
+
+    def stream_embeddings(self, dataset_version, chunk_size: int = 1024) -> Iterator[tuple]:
+        """
+        Yields the `(assets, embeddings)` of the assets of `dataset_version` by chunks, like
+        `load_embeddings` but without holding all the embeddings in memory.
+
+        With an embedding store, the stored embeddings are read first, by chunks of `chunk_size`,
+        then the new assets are embedded and added to the store batch by batch.
+        """
+        assets = dataset_version.list_assets()
+        store = self.embedding_store(dataset_version.id)
+        if store is None:
+            to_embed = assets
+        else:
+            to_embed = store.sync(assets)
+            stored = [asset for asset in assets if str(asset.data_id) in store.rows]
+            for chunk in batched(stored, chunk_size):
+                yield store.get(chunk)
+            # Assets sharing their Data with an asset to embed are read back from the store afterwards
+            queued = {id(asset) for asset in to_embed}
+            shared = [asset for asset in assets if str(asset.data_id) not in store.rows and id(asset) not in queued]
+
+        stats = PipelineStats()
+        embedded = 0
+        for batch in batched(self.iter_embeddings(to_embed, stats=stats), self.batch_size):
+            for asset, _, error in batch:
+                if error is not None:
+                    logger.warning(f"Could not embed asset {asset.filename}: {error}")
+            batch = [(asset, embedding) for asset, embedding, error in batch if error is None]
+            if not batch:
+                continue
+            batch_assets, embeddings = [asset for asset, _ in batch], np.stack([embedding for _, embedding in batch])
+            embedded += len(batch_assets)
+            if store is not None:
+                store.add(batch_assets, embeddings)
+            yield batch_assets, embeddings
+        logger.info(f"Embedded {embedded} of {len(assets)} assets: {stats.as_dict()}")
+
+        if store is not None:
+            store.save()
+            for chunk in batched(shared, chunk_size):
+                chunk_assets, embeddings = store.get(chunk)
+                if chunk_assets:
+                    yield chunk_assets, embeddings
+
+    def iter_outlier_scores(self, dataset_version, quantile: float = 0.85, metric: str = None,
+                            warmup: int = 1024) -> Iterator[tuple]:
+        """
+        Scores the assets of `dataset_version` as their embeddings are computed, with a
+        `utils.streaming_stats.StreamingOutlierScorer`, kept in `self.scorer` for `rescore_outliers`.
+
+        The first `warmup` embeddings are held back and scored at once, so that they are not scored
+        against the mean of a few batches, which would under-flag them.
+
+        Yields:
+            tuple: `(asset, score, threshold)` per asset, where the score is provisional and the
+            threshold the current estimate of the `quantile` of the scores.
+        """
+        self.scorer = None
+        held_assets, held_embeddings = [], []
+        for assets, embeddings in self.stream_embeddings(dataset_version):
+            if self.scorer is None:
+                self.scorer = StreamingOutlierScorer(embeddings.shape[1], quantile=quantile, metric=metric or self.streaming_metric)
+            if not self.scorer.moments.count:
+                held_assets.extend(assets)
+                held_embeddings.append(embeddings)
+                if len(held_assets) < warmup:
+                    continue
+                assets, embeddings = held_assets, np.concatenate(held_embeddings)
+                held_assets, held_embeddings = [], []
+            scores = self.scorer.update(embeddings)
+            threshold = self.scorer.threshold
+            for asset, score in zip(assets, scores):
+                yield asset, float(score), threshold
+
+        # Fewer embeddings than the warmup window
+        if held_assets:
+            scores = self.scorer.update(np.concatenate(held_embeddings))
+            for asset, score in zip(held_assets, scores):
+                yield asset, float(score), self.scorer.threshold
+
+    def rescore_outliers(self, dataset_version, assets: List[Asset], chunk_size: int = 1024) -> Optional[np.ndarray]:
+        """
+        Scores again the stored embeddings of `assets` against the final statistics of `self.scorer`,
+        by chunks read from the embedding store, so that the first and last embedded assets are
+        scored alike.
+
+        Returns:
+            Optional[np.ndarray]: The new score of each asset, or None when the embeddings cannot be read again.
+        """
+        store = self.embedding_store(dataset_version.id)
+        if store is None or self.scorer is None:
+            return None
+        precision = self.scorer.precision()
+        scores = []
+        for chunk in batched(assets, chunk_size):
+            stored, embeddings = store.get(chunk)
+            if len(stored) != len(chunk):
+                logger.warning("Some scored embeddings are missing from the store, keeping the provisional scores.")
+                return None
+            scores.append(self.scorer.score(embeddings, precision=precision))
+        return np.concatenate(scores) if scores else np.zeros(0)
+
+    def embedding_index(self, dataset_version) -> tuple:
+        """
+        Returns an approximate nearest-neighbour index over the embeddings of `dataset_version`,
+        whose ids are asset ids, along with the `(assets, embeddings)` of `load_embeddings`.
+
+        With an embedding store, the index is saved next to the embeddings and later calls only
+        add the new assets and remove the deleted ones.
+        """
+        assets, embeddings = self.load_embeddings(dataset_version)
+        ids = [str(asset.id) for asset in assets]
+        index = create_index(embeddings.shape[1], backend=self.ann_backend)
+        store = self.embedding_store(dataset_version.id)
+        path = None
+        if store is not None:
+            path = os.path.join(store.root, "ann.faiss" if isinstance(index, FaissIndex) else "ann.npz")
+
+        if path is not None and os.path.exists(path):
+            index = load_index(path)
+            indexed = index.indexed_ids()
+            current = set(ids)
+            index.remove([id for id in indexed if id not in current])
+            new_rows = [row for row, id in enumerate(ids) if id not in indexed]
+            if new_rows:
+                index.add(embeddings[new_rows], [ids[row] for row in new_rows])
+        elif ids:
+            index.build(embeddings, ids)
+
+        if path is not None and len(index):
+            index.save(path)
+        return index, assets, embeddings
+
+    def iter_embeddings(self, assets: Iterable[Asset], batch_size: int = None, stats: PipelineStats = None) -> Iterator[tuple]:
+        """
+        Embeds `assets` by batches of `batch_size`, the next images being downloaded and
+        preprocessed by a thread pool while the current batch runs through CLIP.
+
+        Yields:
+            tuple: `(asset, embedding, error)` per asset, in order, where `embedding` is None
+            and `error` describes the failure when the asset could not be embedded.
+        """
+        batch_size = batch_size or self.batch_size
+        stats = stats if stats is not None else PipelineStats()
+        loaded_assets = prefetch(assets, self.load_input, max_workers=self.num_workers,
+                                 depth=self.prefetch_batches * batch_size, stats=stats)
+        for batch in batched(loaded_assets, batch_size):
+            loaded = [(asset, pixels) for asset, pixels, error in batch if error is None]
+            embeddings = []
+            if loaded:
+                try:
+                    with stats.timer("compute"):
+                        # Through the shared service, the batch is run with the concurrent requests of other tools
+                        futures = self.submit_pixels([pixels for _, pixels in loaded])
+                        embeddings = [future.result() for future in futures]
+                except Exception as e:
+                    for asset, _, _ in batch:
+                        yield asset, None, f"inference failed: {e}"
+                    continue
+
+            embeddings_by_asset = {id(asset): embedding for (asset, _), embedding in zip(loaded, embeddings)}
+            for asset, _, error in batch:
+                if error is not None:
+                    yield asset, None, f"download failed: {error}"
+                else:
+                    yield asset, embeddings_by_asset[id(asset)], None
+
     def compute_asset_embeddings(self, asset: Asset) -> np.array:
         try:
-            image_url = asset.url  # Assuming each asset has a URL attribute
-            image = Image.open(requests.get(image_url, stream=True).raw).convert("RGB")
-            inputs = self.processor(images=image, return_tensors="pt").to(self.device)
-            
-            # Compute the embedding using the CLIP model
-            with torch.no_grad():
-                embedding = self.model.get_image_features(**inputs)
-            embedding = embedding / embedding.norm(dim=-1, keepdim=True)
-            return embedding.cpu().numpy().flatten()
+            # Batched with the concurrent embedding requests of the other tools
+            return self.submit_pixels([self.load_input(asset)])[0].result()
 
         except Exception as e:
             print(f"Error processing asset {asset.filename}: {e}")
             return None
 
-    def forward(self, client: Client, dataset_version_id: str) -> bool:
+    def forward(self, client: Client, dataset_version_id: str, method: str = None, contamination=None) -> bool:
         """
         Processes a dataset version to find outlier assets using the specified search type.
 
@@ -63,6 +358,9 @@ class DatasetVersionEmbeddingTool(Tool):
         Args:
             client (Client): Authenticated Picsellia client instance.
             dataset_version_id (str): ID of the dataset version to analyze.
+            method (str, optional): One of `utils.outliers.OUTLIER_METHODS`, `self.outlier_method` by default.
+            contamination (Union[float, str], optional): Expected fraction of outliers or `auto`,
+                `self.contamination` by default.
 
         Returns:
             bool: True if outliers found, False if not.
@@ -73,23 +371,43 @@ class DatasetVersionEmbeddingTool(Tool):
         """
         self.embeddings = []
         self.asset_ids = []
+        method = method or self.outlier_method
+        contamination = parse_contamination(contamination if contamination is not None else self.contamination)
+        if method not in OUTLIER_METHODS:
+            raise ValueError(f"Unknown outlier method {method}, expected one of {OUTLIER_METHODS}.")
 
         try:
             dataset_version = client.get_dataset_version_by_id(dataset_version_id)
-            assets = dataset_version.list_assets()
-            for asset in assets:
-                embedding = self.compute_asset_embeddings(asset)
-                self.embeddings.append(embedding)
         except ResourceNotFoundError:
             raise ValueError(f"Dataset version with id {dataset_version_id} not found.")
 
-        embeddings_array = np.array(self.embeddings)
-        centroid = np.mean(embeddings_array, axis=0)
-        centroid_distances = np.linalg.norm(embeddings_array - centroid, axis=1)
-        
-        outlier_threshold = np.percentile(centroid_distances, 85)
-        outliers = np.where(centroid_distances > outlier_threshold)[0]
-        
+        # The neighbours of the knn and lof scores need all the embeddings, only the centroid score streams
+        if self.streaming and method == "centroid":
+            if contamination == "auto":
+                raise ValueError("Streaming outlier scores require a numeric contamination.")
+            # Only the assets and their scores are kept, not the embeddings. The provisional scores and
+            # thresholds are only used to report the progress
+            assets, scores, provisional_outliers = [], [], 0
+            for asset, score, threshold in self.iter_outlier_scores(dataset_version, quantile=1 - contamination):
+                assets.append(asset)
+                scores.append(score)
+                provisional_outliers += score > threshold
+                if len(assets) % 1000 == 0:
+                    logger.info(f"Scored {len(assets)} assets, {provisional_outliers} provisional outliers")
+            self.asset_ids = [asset.id for asset in assets]
+            rescored = self.rescore_outliers(dataset_version, assets)
+            scores = rescored if rescored is not None else np.asarray(scores)
+            # Every score is at hand, the threshold is their exact quantile rather than the P² estimate
+            outliers = np.where(scores > outlier_threshold(scores, contamination))[0] if len(scores) else []
+        else:
+            assets, embeddings_array = self.load_embeddings(dataset_version)
+            self.embeddings = list(embeddings_array)
+            self.asset_ids = [asset.id for asset in assets]
+
+            # Blockwise over the embeddings for knn and lof, see `utils.outliers.nearest_neighbours`
+            scores = outlier_scores(embeddings_array, method, k=self.neighbours)
+            outliers = np.where(scores > outlier_threshold(scores, contamination))[0] if len(scores) else []
+
         outlier_assets = [assets[i] for i in outliers]
         assets = MultiAsset(dataset_version.connexion, dataset_version.id, outlier_assets)
         tag = dataset_version.get_or_create_asset_tag('agent-suspects-outlier')
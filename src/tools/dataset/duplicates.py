@@ -0,0 +1,169 @@
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union
+
+from picsellia import DatasetVersion
+from picsellia.sdk.asset import MultiAsset
+from picsellia.sdk.data import MultiData
+from smolagents import Tool
+
+from utils.image_cache import fetch_asset_bytes
+from utils.phash import HASH_METHODS, group_near_duplicates, hash_image_bytes, hash_many
+from utils.pipeline import PipelineStats, batched, prefetch
+
+logger = logging.getLogger(__name__)
+
+NEAR_DUPLICATE_TAG = "agent-near-duplicate"
+
+
+class NearDuplicateDetectorTool(Tool):
+    name = "near_duplicate_detector"
+    description = """
+    This tool finds near-duplicate images (resized, recompressed or slightly edited copies) in a DatasetVersion
+    or in the MultiData returned by a Datalake search, using perceptual hashes, which is much cheaper than
+    embeddings. In a DatasetVersion, the near-duplicate assets are tagged `agent-near-duplicate`.
+    It returns a report with the groups of near-duplicate asset or data ids.
+    """
+    inputs = {
+        "items": {
+            "type": "object",
+            "description": "The DatasetVersion or the MultiData to search for near-duplicates",
+        },
+        "max_distance": {
+            "type": "integer",
+            "description": "Maximum number of differing bits (out of 64) between the hashes of near-duplicates, 4 by default",
+            "nullable": "True"
+        },
+        "method": {
+            "type": "string",
+            "description": "Perceptual hash to use, `phash` (default, robust to edits) or `dhash` (faster)",
+            "nullable": "True"
+        },
+    }
+    output_type = "object"
+
+    def __init__(self, num_workers: int = 16, num_processes: int = os.cpu_count() or 1, chunk_size: int = 256,
+                 task_size: int = 32, **kwargs):
+        super().__init__(**kwargs)
+        # Threads downloading the images, processes decoding and hashing them
+        self.num_workers = num_workers
+        self.num_processes = num_processes
+        # Images downloaded ahead, and sent to a worker process at once
+        self.chunk_size = chunk_size
+        self.task_size = task_size
+
+    def compute_hashes(self, items: list, method: str = "phash", stats: PipelineStats = None) -> tuple:
+        """
+        Returns the `(hashes, failures)` of `items`, where `hashes` maps the index of each hashed
+        item to its 64-bit hash and `failures` the index of the others to their error.
+
+        Images are downloaded by a thread pool and hashed by chunks in a process pool, the next
+        chunks being downloaded while the previous ones are hashed.
+        """
+        stats = stats if stats is not None else PipelineStats()
+        hashes, failures = {}, {}
+        loaded = prefetch(list(enumerate(items)), lambda entry: fetch_asset_bytes(entry[1]),
+                          max_workers=self.num_workers, depth=2 * self.chunk_size, stats=stats)
+
+        if self.num_processes <= 1:
+            for (index, _), data, error in loaded:
+                if error is not None:
+                    failures[index] = f"download failed: {error}"
+                    continue
+                try:
+                    with stats.timer("compute"):
+                        hashes[index] = hash_image_bytes(data, method)
+                except Exception as e:
+                    failures[index] = str(e)
+            return hashes, failures
+
+        def collect(indices, futures):
+            results = []
+            for future in futures:
+                try:
+                    results.extend(future.result())
+                except Exception as e:
+                    results.extend([(None, f"worker failed: {e}")] * (len(indices) - len(results)))
+                    break
+            for index, (hash, error) in zip(indices, results):
+                if error is not None:
+                    failures[index] = error
+                else:
+                    hashes[index] = hash
+
+        with ProcessPoolExecutor(max_workers=self.num_processes,
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            pending = deque()
+            for chunk in batched(loaded, self.chunk_size):
+                indices, datas = [], []
+                for (index, _), data, error in chunk:
+                    if error is not None:
+                        failures[index] = f"download failed: {error}"
+                        continue
+                    indices.append(index)
+                    datas.append(data)
+                futures = [pool.submit(hash_many, datas[offset:offset + self.task_size], method)
+                           for offset in range(0, len(datas), self.task_size)]
+                pending.append((indices, futures))
+                # Keeps a couple of chunks in flight, so that downloaded images are not all held in memory
+                while len(pending) > 2:
+                    collect(*pending.popleft())
+            while pending:
+                collect(*pending.popleft())
+        return hashes, failures
+
+    def forward(self, items: Union[DatasetVersion, MultiData], max_distance: int = 4, method: str = "phash") -> dict:
+        """
+        Finds the groups of near-duplicate images of a DatasetVersion or a MultiData.
+
+        Args:
+            items (Union[DatasetVersion, MultiData]): The images to compare.
+            max_distance (int): Maximum Hamming distance between the 64-bit hashes of near-duplicates.
+            method (str): `phash` or `dhash`.
+
+        Returns:
+            dict: A report with `hashed`, `failed`, `failures` (id -> error), `groups` (lists of ids of
+            near-duplicate images, largest first), `duplicates` (number of images that have a near-duplicate
+            earlier in their group), `tag` (the tag added in a DatasetVersion, if any), `elapsed_seconds`
+            and `images_per_minute`.
+        """
+        max_distance = 4 if max_distance is None else max_distance
+        method = method or "phash"
+        if method not in HASH_METHODS:
+            raise ValueError(f"Unknown hash method {method}, expected one of {HASH_METHODS}.")
+
+        dataset_version = items if isinstance(items, DatasetVersion) else None
+        items = list(dataset_version.list_assets() if dataset_version is not None else items)
+
+        start = time.time()
+        stats = PipelineStats()
+        hashes, failures = self.compute_hashes(items, method, stats=stats)
+        hashed = sorted(hashes)
+        groups = [[hashed[i] for i in group] for group in group_near_duplicates([hashes[i] for i in hashed], max_distance)]
+        elapsed = time.time() - start
+        logger.info(f"Hashed {len(hashes)} images in {elapsed:.1f}s: {stats.as_dict()}")
+
+        tag = None
+        if dataset_version is not None and groups:
+            duplicate_assets = [items[index] for group in groups for index in group]
+            tag = dataset_version.get_or_create_asset_tag(NEAR_DUPLICATE_TAG)
+            MultiAsset(dataset_version.connexion, dataset_version.id, duplicate_assets).add_tags(tag)
+            tag = NEAR_DUPLICATE_TAG
+
+        return {
+            "hashed": len(hashes),
+            "failed": len(failures),
+            "failures": {str(items[index].id): error for index, error in failures.items()},
+            "groups": [[str(items[index].id) for index in group] for group in groups],
+            "duplicates": sum(len(group) - 1 for group in groups),
+            "tag": tag,
+            "elapsed_seconds": round(elapsed, 2),
+            "images_per_minute": round(60 * len(hashes) / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+
+
+near_duplicate_detector = NearDuplicateDetectorTool()
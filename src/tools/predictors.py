@@ -2,17 +2,72 @@ import picsellia
 import picsellia.types
 import picsellia.types.enums
 import picsellia.types.schemas
-from picsellia import Label, Asset
-import requests
+from picsellia import Label, Asset, DatasetVersion
+from picsellia.exceptions import NoDataError
+from picsellia.sdk.asset import MultiAsset
 from PIL import Image
 import torch
 from transformers import Owlv2Processor, Owlv2ForObjectDetection
-from typing import List, Generator
+from transformers.models.owlv2.modeling_owlv2 import Owlv2ObjectDetectionOutput
+from typing import Iterable, Iterator, List, Generator, Sequence, Union
+import hashlib
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import threading
 import time 
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from smolagents import tools, Tool
 import numpy as np
-from utils.label import find_picsellia_label
+from utils.annotations import AnnotationWriter, BulkAnnotationWriter
+from utils.backends import BACKENDS, load_vision_backend
+from utils.batching import inference_service
+from utils.cache import LRUCache
+from utils.detection import MAX_AREA_RATIO, MIN_AREA_RATIO, SCORE_THRESHOLD, filter_detections
+from utils.disk_cache import DiskCache
+from utils.downloads import download_client
+from utils.feature_store import ImageFeatureStore
+from utils.image_cache import fetch_asset_bytes, is_asset_cached
+from utils.images import decode_image
+from utils.journal import DEFAULT_JOURNAL_PATH, PreAnnotationJournal
+from utils.models import model_registry
+from utils.pipeline import PipelineStats, batched, prefetch
+from utils.pixel_cache import PixelCache
+from utils.preprocessing import owlv2_preprocess
 
+OWLV2_MODEL_ID = "google/owlv2-base-patch16-ensemble"
+DEFAULT_PROMPT_TEMPLATES = ("a photo of a {label}",)
+IMAGE_FEATURE_FIELDS = ("image_feats", "pred_boxes", "image_size")
+# Detections scoring below are dropped by the OWLv2 post-processing, before any caching or filtering,
+# unless the detector is configured with a lower `score_threshold`, see `raw_score_threshold`
+RAW_SCORE_THRESHOLD = 0.1
+# Presigned urls of assets expire after an hour, they are requested again past this age
+URL_REFRESH_SECONDS = 30 * 60
+
+logger = logging.getLogger(__name__)
+
+
+def _dump_result(result: dict) -> bytes:
+    buffer = io.BytesIO()
+    np.savez(buffer, **{key: value.cpu().numpy() for key, value in result.items()})
+    return buffer.getvalue()
+
+
+def _load_result(data: bytes) -> dict:
+    if data is None:
+        return None
+    with np.load(io.BytesIO(data)) as arrays:
+        return {key: torch.from_numpy(arrays[key]) for key in arrays.files}
+
+
+def _stack(arrays: list) -> torch.Tensor:
+    # Stored features are read-only memory maps, they are copied before becoming tensors
+    return torch.stack([array if torch.is_tensor(array) else torch.from_numpy(np.array(array)) for array in arrays])
 
 
 class ZeroShotDetectorTool(Tool):
@@ -35,82 +90,766 @@ class ZeroShotDetectorTool(Tool):
     }
     output_type = "string"
 
-    def forward(self, labels: List[Label], asset: Asset) -> str:
-        start = time.time()
+    def __init__(self, model_id: str = OWLV2_MODEL_ID, device: str = None,
+                 prompt_templates: Sequence[str] = DEFAULT_PROMPT_TEMPLATES, query_cache_size: int = 32,
+                 feature_store_dir: str = os.getenv("OWLV2_FEATURE_STORE_DIR"),
+                 feature_store_max_mb: int = int(os.getenv("OWLV2_FEATURE_STORE_MAX_MB", "20480")),
+                 backend: str = os.getenv("OWLV2_BACKEND", "eager"),
+                 result_cache_dir: str = os.getenv("OWLV2_RESULT_CACHE_DIR"),
+                 result_cache_max_mb: int = int(os.getenv("OWLV2_RESULT_CACHE_MAX_MB", "1024")),
+                 fast_preprocessing: bool = os.getenv("OWLV2_FAST_PREPROCESSING", "0") == "1",
+                 pixel_cache_dir: str = os.getenv("OWLV2_PIXEL_CACHE_DIR"),
+                 pixel_cache_max_mb: int = int(os.getenv("OWLV2_PIXEL_CACHE_MAX_MB", "20480")),
+                 score_threshold: float = SCORE_THRESHOLD, min_area_ratio: float = MIN_AREA_RATIO,
+                 max_area_ratio: float = MAX_AREA_RATIO, **kwargs):
+        super().__init__(**kwargs)
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}.")
+        self.model_id = model_id
+        self.device = device
+        # Runtime of the vision backbone, see `utils.backends.load_vision_backend`
+        self.backend = backend
+        # Torch implementation of the image preprocessing, see `utils.preprocessing.owlv2_preprocess`
+        self.fast_preprocessing = fast_preprocessing
+        # Each template must contain a `{label}` placeholder, the embeddings of all templates are averaged
+        self.prompt_templates = tuple(prompt_templates)
+        self.query_cache_size = query_cache_size
+        self.query_cache = LRUCache(maxsize=query_cache_size)
+        # Optional on-disk store of the vision backbone outputs, re-querying stored images with new labels
+        # only costs the class head. Entries are ~5MB per image (fp16 image features), the least recently
+        # used ones are evicted past `feature_store_max_mb`.
+        self.feature_store_dir = feature_store_dir
+        self.feature_store_max_mb = feature_store_max_mb
+        self.feature_store = ImageFeatureStore(
+            feature_store_dir, f"{model_id}-{backend}" + ("-fast" if fast_preprocessing else ""),
+            max_bytes=feature_store_max_mb * 1024 ** 2,
+        ) if feature_store_dir else None
+        # Optional on-disk cache of the raw detections (before filtering) per image content, model and prompts
+        self.result_cache_dir = result_cache_dir
+        self.result_cache_max_mb = result_cache_max_mb
+        self.result_cache = DiskCache(result_cache_dir, result_cache_max_mb * 1024 ** 2) if result_cache_dir else None
+        # Optional on-disk cache of the preprocessed fp16 pixels (~5.5MB per image), created on first use
+        # as its layout depends on the processor, see `pixel_cache`. Capped to `pixel_cache_max_mb`.
+        self.pixel_cache_dir = pixel_cache_dir
+        self.pixel_cache_max_mb = pixel_cache_max_mb
+        self._pixel_cache = None
+        self._pixel_cache_lock = threading.Lock()
+        # Filtering of the raw detections, changing them does not invalidate the result cache unless
+        # `score_threshold` goes below `RAW_SCORE_THRESHOLD`, see `raw_score_threshold`
+        self.score_threshold = score_threshold
+        self.min_area_ratio = min_area_ratio
+        self.max_area_ratio = max_area_ratio
+
+    def config(self) -> dict:
+        """Returns the keyword arguments rebuilding an equivalent detector, e.g. in another process."""
+        return {
+            "model_id": self.model_id,
+            "prompt_templates": self.prompt_templates,
+            "query_cache_size": self.query_cache_size,
+            "feature_store_dir": self.feature_store_dir,
+            "feature_store_max_mb": self.feature_store_max_mb,
+            "backend": self.backend,
+            "fast_preprocessing": self.fast_preprocessing,
+            "pixel_cache_dir": self.pixel_cache_dir,
+            "pixel_cache_max_mb": self.pixel_cache_max_mb,
+            "result_cache_dir": self.result_cache_dir,
+            # Workers share the directory, a smaller budget would trim it for every process
+            "result_cache_max_mb": self.result_cache_max_mb,
+            "score_threshold": self.score_threshold,
+            "min_area_ratio": self.min_area_ratio,
+            "max_area_ratio": self.max_area_ratio,
+        }
+
+    def job_config(self, labels: List[Label]) -> dict:
+        """Returns everything that determines the annotations created for `labels`."""
+        return {
+            "model_id": self.model_id,
+            "backend": self.backend,
+            "fast_preprocessing": self.fast_preprocessing,
+            "prompts": self.build_prompts(labels),
+            "score_threshold": self.score_threshold,
+            "min_area_ratio": self.min_area_ratio,
+            "max_area_ratio": self.max_area_ratio,
+        }
+
+    @property
+    def raw_score_threshold(self) -> float:
+        """Score threshold of the post-processing, low enough to keep every detection `score_threshold` keeps."""
+        return min(RAW_SCORE_THRESHOLD, self.score_threshold)
+
+    def load_model(self):
+        # Loaded once per process and shared through the registry
+        return model_registry.get(Owlv2ForObjectDetection, Owlv2Processor, self.model_id, device=self.device)
+
+    def load_vision_backend(self, backend: str = None):
+        model, _ = self.load_model()
+        return load_vision_backend(model, self.model_id, backend or self.backend, image_size=self.input_resolution())
+
+    def input_resolution(self) -> int:
+        """Returns the side of the square images OWLv2 runs on."""
+        _, processor = self.load_model()
+        return processor.image_processor.size["height"]
+
+    def pixel_cache(self) -> PixelCache:
+        """Returns the cache of preprocessed pixels, or None if `pixel_cache_dir` is not set."""
+        if self.pixel_cache_dir is None:
+            return None
+        with self._pixel_cache_lock:
+            if self._pixel_cache is None:
+                image_processor = self.load_model()[1].image_processor
+                size = image_processor.size["height"]
+                config = {
+                    "model_id": self.model_id,
+                    "size": size,
+                    "image_mean": list(image_processor.image_mean),
+                    "image_std": list(image_processor.image_std),
+                    "fast_preprocessing": self.fast_preprocessing,
+                }
+                self._pixel_cache = PixelCache(self.pixel_cache_dir, config, shape=(3, size, size),
+                                               max_bytes=self.pixel_cache_max_mb * 1024 ** 2)
+            return self._pixel_cache
+
+    def preprocess(self, images: List[Union[Image.Image, dict]]) -> torch.Tensor:
+        """
+        Returns the pixel values of a batch of images, on the device of the model.
+
+        Inputs read from the pixel cache by `load_input` are used as is, the pixels of the
+        other images are written to the cache when one is configured.
+        """
+        model, _ = self.load_model()
+        pixel_values = [None] * len(images)
+        to_process = []
+        for i, image in enumerate(images):
+            if isinstance(image, dict):
+                pixel_values[i] = torch.from_numpy(image["pixel_values"])
+            else:
+                to_process.append(i)
+
+        if to_process:
+            processed = self._preprocess([images[i] for i in to_process])
+            pixel_cache = self.pixel_cache()
+            for i, pixels in zip(to_process, processed):
+                pixel_values[i] = pixels
+                content_hash = self.content_hash(images[i])
+                if pixel_cache is not None and content_hash is not None:
+                    pixel_cache.put(content_hash, pixels.numpy().astype(np.float16),
+                                    {"image_size": list(self.input_size(images[i]))})
+
+        dtype = processed.dtype if to_process else torch.float32
+        return torch.stack([pixels.to(dtype) for pixels in pixel_values]).to(model.device)
+
+    def _preprocess(self, images: List[Image.Image]) -> torch.Tensor:
+        _, processor = self.load_model()
+        if self.fast_preprocessing:
+            image_processor = processor.image_processor
+            # Grey padding, as in the original OWLv2 preprocessing
+            pixel_values = owlv2_preprocess(images, size=image_processor.size["height"],
+                                            mean=image_processor.image_mean, std=image_processor.image_std)
+        else:
+            pixel_values = processor(images=images, return_tensors="pt")["pixel_values"]
+        return pixel_values
+
+    def load_image(self, asset: Asset) -> Image.Image:
+        # Decoded close to the model resolution, boxes are scaled back to the original size
+        return decode_image(fetch_asset_bytes(asset), target_size=self.input_resolution(), fit="longest")
+
+    def load_input(self, asset: Asset) -> Union[Image.Image, dict]:
+        """
+        Returns the stored image features of `asset` when the feature store has them, then its
+        preprocessed pixels when the pixel cache has them, otherwise downloads and decodes its image.
+        """
+        if self.feature_store is not None:
+            key = self.feature_store.lookup(asset.data_id)
+            features = self.feature_store.get(key, IMAGE_FEATURE_FIELDS) if key is not None else None
+            if features is not None:
+                features["content_hash"] = key
+                return features
+        pixel_cache = self.pixel_cache()
+        if pixel_cache is not None:
+            key = pixel_cache.lookup(asset.data_id)
+            entry = pixel_cache.get(key) if key is not None else None
+            if entry is not None:
+                pixels, meta = entry
+                return {"pixel_values": pixels, "image_size": meta["image_size"], "content_hash": key}
+        image = self.load_image(asset)
+        if self.feature_store is not None:
+            self.feature_store.link(asset.data_id, image.info["content_hash"])
+        if pixel_cache is not None:
+            pixel_cache.link(asset.data_id, image.info["content_hash"])
+        return image
+
+    @staticmethod
+    def content_hash(input: Union[Image.Image, dict]) -> str:
+        """Returns the sha256 of the image content an input comes from, or None if unknown."""
+        if isinstance(input, dict):
+            return input.get("content_hash")
+        return input.info.get("content_hash")
+
+    @staticmethod
+    def input_size(input: Union[Image.Image, dict]) -> tuple:
+        """Returns the original (width, height) of an image or of the image stored features were computed on."""
+        if isinstance(input, dict):
+            return tuple(int(size) for size in input["image_size"])
+        return input.info.get("original_size", input.size)
+
+    def build_prompts(self, labels: List[Label]) -> List[str]:
+        return [template.format(label=label.name) for label in labels for template in self.prompt_templates]
 
-        # Initialize model and processor
-        processor = Owlv2Processor.from_pretrained("google/owlv2-base-patch16-ensemble")
-        model = Owlv2ForObjectDetection.from_pretrained("google/owlv2-base-patch16-ensemble")
-        model.to(device='mps')
+    def encode_queries(self, labels: List[Label]) -> torch.Tensor:
+        """
+        Returns the OWLv2 text-query embeddings of `labels`, one row per label.
 
-        # Prepare image and text inputs
-        image = Image.open(requests.get(asset.url, stream=True).raw)
-        texts = [[f"a photo of a {label.name}" for label in labels]]
+        The text tower only runs once per (model, prompts), later calls with the same labels
+        are served from `query_cache`.
+        """
+        prompts = tuple(self.build_prompts(labels))
+        model, processor = self.load_model()
+        key = (self.model_id, str(model.device), prompts)
 
-        # Process inputs
-        inputs = processor(text=texts, images=image, return_tensors="pt")
-        inputs.to(device="mps")
+        def compute() -> torch.Tensor:
+            text_inputs = processor(text=list(prompts), return_tensors="pt").to(model.device)
+            with torch.no_grad():
+                text_embeds = model.owlv2.get_text_features(
+                    input_ids=text_inputs["input_ids"],
+                    attention_mask=text_inputs["attention_mask"],
+                )
+            # Prompt ensembling: average the normalized embeddings of every template of a label
+            text_embeds = text_embeds / text_embeds.norm(dim=-1, keepdim=True)
+            return text_embeds.reshape(len(labels), len(self.prompt_templates), -1).mean(dim=1)
 
-        # Run inference
+        return self.query_cache.get_or_compute(key, compute)
+
+    def embed_images(self, images: List[Union[Image.Image, dict]]) -> List[dict]:
+        """
+        Runs the OWLv2 vision backbone and box head on a batch of images, or of preprocessed
+        pixels read from the pixel cache.
+
+        This is the expensive part of the detection and does not depend on the labels, its
+        outputs are written to the feature store when one is configured.
+
+        Returns:
+            List[dict]: Per image `image_feats` (num_patches x hidden_size), `pred_boxes`
+            (num_patches x 4) and `image_size` (width, height).
+        """
+        image_feats, pred_boxes = self.load_vision_backend()(self.preprocess(images))
+
+        features = []
+        for i, image in enumerate(images):
+            image_features = {
+                "image_feats": image_feats[i],
+                "pred_boxes": pred_boxes[i],
+                "image_size": np.array(self.input_size(image)),
+                "content_hash": self.content_hash(image),
+            }
+            if self.feature_store is not None and image_features["content_hash"] is not None:
+                self.feature_store.put(image_features["content_hash"], {
+                    "image_feats": image_feats[i].cpu().numpy().astype(np.float16),
+                    "pred_boxes": pred_boxes[i].cpu().numpy(),
+                    "image_size": image_features["image_size"],
+                })
+            features.append(image_features)
+        return features
+
+    def submit(self, input: Union[Image.Image, dict], labels: List[Label]) -> Future:
+        """
+        Queues one input to the shared inference service and returns the future of its `predict` result.
+
+        Concurrent calls with the same labels, e.g. from several agents, are run as a single batch.
+        """
+        key = ("owlv2", id(self), tuple(self.build_prompts(labels)))
+        return inference_service.submit(key, lambda inputs: self.predict(inputs, labels), input)
+
+    def _result_key(self, input: Union[Image.Image, dict], labels: List[Label]) -> str:
+        content_hash = self.content_hash(input)
+        if content_hash is None:
+            return None
+        config = json.dumps([self.model_id, self.backend, self.fast_preprocessing, self.build_prompts(labels), self.raw_score_threshold])
+        return hashlib.sha256(f"{content_hash}:{config}".encode()).hexdigest()
+
+    def predict(self, inputs: List[Union[Image.Image, dict]], labels: List[Label]) -> List[dict]:
+        """
+        Returns the raw detections of each input, from the result cache when possible.
+
+        Takes the same arguments and returns the same results as `_predict`. Cached detections only
+        depend on the image content, the model and the prompts: thresholds and area filters are applied
+        afterwards by `filter_result`, so changing them does not require running the model again.
+        """
+        if self.result_cache is None:
+            return self._predict(inputs, labels)
+
+        keys = [self._result_key(input, labels) for input in inputs]
+        results = [_load_result(self.result_cache.get(key)) if key is not None else None for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            for i, result in zip(missing, self._predict([inputs[i] for i in missing], labels)):
+                results[i] = result
+                if keys[i] is not None:
+                    self.result_cache.put(keys[i], _dump_result(result))
+        return results
+
+    def _predict(self, inputs: List[Union[Image.Image, dict]], labels: List[Label]) -> List[dict]:
+        """
+        Runs OWLv2 on a batch of images with the same text queries.
+
+        Args:
+            inputs (List[Union[Image.Image, dict]]): Decoded RGB images, preprocessed pixels read from the
+                pixel cache, or image features previously returned by `embed_images` or read from the
+                feature store, which skip the vision backbone.
+            labels (List[Label]): Picsellia labels to query.
+
+        Returns:
+            List[dict]: One post-processed result per image, with `boxes`, `scores` and `labels` tensors.
+        """
+        model, processor = self.load_model()
+
+        # Only the images without stored features go through the vision backbone
+        features = list(inputs)
+        to_embed = [i for i, input in enumerate(inputs) if not isinstance(input, dict) or "image_feats" not in input]
+        if to_embed:
+            for i, image_features in zip(to_embed, self.embed_images([inputs[i] for i in to_embed])):
+                features[i] = image_features
+
+        dtype = next(model.parameters()).dtype
+        image_feats = _stack([f["image_feats"] for f in features]).to(model.device, dtype)
+        pred_boxes = _stack([f["pred_boxes"] for f in features]).to(model.device)
+
+        # Every image of the batch is queried with the same cached text embeddings,
+        # only the cheap class head depends on the labels
+        query_embeds = self.encode_queries(labels)
         with torch.no_grad():
-            outputs = model(**inputs)
+            queries = query_embeds.unsqueeze(0).expand(len(features), -1, -1)
+            logits, _ = model.class_predictor(image_feats, queries)
+        outputs = Owlv2ObjectDetectionOutput(logits=logits, pred_boxes=pred_boxes)
 
-        # Post-process results
-        target_sizes = torch.Tensor([image.size[::-1]])
-        results = processor.post_process_object_detection(
+        # Post-process results, OWLv2 pads images at the bottom and right to a square so boxes are
+        # relative to a square whose side is the largest dimension of the image
+        target_sizes = torch.Tensor([[max(self.input_size(f))] * 2 for f in features])
+        return processor.post_process_object_detection(
             outputs=outputs,
             target_sizes=target_sizes,
-            threshold=0.1
+            threshold=self.raw_score_threshold
         )
 
-        # Create annotation if detections exist
-        boxes = results[0]["boxes"]
-        scores = results[0]["scores"]
-        detected_labels = results[0]["labels"]
-        elapsed = time.time() - start
-        image_width, image_height = image.size
-
-        if len(boxes) > 0:
-            # Calculate average box area
-            areas = [(box[2] - box[0]) * (box[3] - box[1]) for box in boxes]
-            avg_area = sum(areas) / len(areas)
-
-            # Define size thresholds based on average area
-            MIN_BOX_AREA = 0.5 * avg_area
-            MAX_BOX_AREA = 2.0 * avg_area
-
-            annotation = asset.create_annotation(duration=elapsed)
-            rectangles = []
-            # Process each detection
-            for box, score, label_idx in zip(boxes, scores, detected_labels):
-                if round(score.item(), 3) > 0.15:
-                    box = [int(coord) for coord in box.tolist()]
-                    x = np.clip(box[0], 0, image_width - 1)  # Ensure x is within the image width
-                    y = np.clip(box[1], 0, image_height - 1)  # Ensure y is within the image height
-                    w = np.clip(box[2], 0, image_width - 1) - x  # Clip the width and adjust relative to x
-                    h = np.clip(box[3], 0, image_height - 1) - y
-
-                    # Calculate area of the current box
-                    area = w * h
-
-                    # Filter out boxes that are outside the area thresholds
-                    if area < MIN_BOX_AREA or area > MAX_BOX_AREA:
-                        continue
-
-                    # Get corresponding Picsellia label
-                    text = texts[0][label_idx]
-                    pic_label = find_picsellia_label(labels, text)
-                    # Create rectangle annotation
-                    rectangles.append((int(x), int(y), int(w), int(h), pic_label))
+    def filter_result(self, result: dict, image_size: tuple) -> tuple:
+        """
+        Filters the post-processed detections of one image, see `utils.detection.filter_detections`.
+        """
+        return filter_detections(
+            result["boxes"].cpu().numpy(), result["scores"].cpu().numpy(), result["labels"].cpu().numpy(), image_size,
+            score_threshold=self.score_threshold, min_area_ratio=self.min_area_ratio, max_area_ratio=self.max_area_ratio,
+        )
+
+    @staticmethod
+    def to_rectangles(detections: tuple, labels: List[Label]) -> List[tuple]:
+        """Converts filtered detections to Picsellia `(x, y, w, h, label)` rectangles."""
+        xywh, label_ids, _ = detections
+        # Queries are ordered as `labels`, so the query index is the label index
+        return [(x, y, w, h, labels[label_id]) for (x, y, w, h), label_id in zip(xywh.tolist(), label_ids.tolist())]
+
+    def build_rectangles(self, result: dict, image_size: tuple, labels: List[Label]) -> List[tuple]:
+        """
+        Filters the detections of one image and returns them as Picsellia `(x, y, w, h, label)` rectangles.
+        """
+        return self.to_rectangles(self.filter_result(result, image_size), labels)
+
+    def _detect_assets(self, assets: Iterable[Asset], labels: List[Label], batch_size: int = 8, num_workers: int = 4,
+                       prefetch_batches: int = 2, stats: PipelineStats = None) -> Iterator[tuple]:
+        """
+        Detects objects on `assets` by batches, images being loaded ahead by a thread pool.
+
+        Yields:
+            tuple: `(asset, detections, duration, error)` per asset, where `detections` is the output
+            of `filter_result` and `error` describes why the asset could not be processed, if so.
+        """
+        stats = stats if stats is not None else PipelineStats()
+        download_client.reserve(num_workers)
+
+        # Next images are downloaded and decoded while the current batch is in the model
+        loaded_assets = prefetch(assets, self.load_input, max_workers=num_workers,
+                                 depth=prefetch_batches * batch_size, stats=stats)
+        for batch in batched(loaded_assets, batch_size):
+            batch_assets, batch_inputs = [], []
+            for asset, input, error in batch:
+                if error is not None:
+                    yield asset, None, 0.0, f"download failed: {error}"
+                    continue
+                batch_assets.append(asset)
+                batch_inputs.append(input)
+            if not batch_inputs:
+                continue
+
+            batch_start = time.time()
+            try:
+                with stats.timer("compute"):
+                    results = self.predict(batch_inputs, labels)
+            except Exception as e:
+                for asset in batch_assets:
+                    yield asset, None, 0.0, f"inference failed: {e}"
+                continue
+            duration = (time.time() - batch_start) / len(batch_inputs)
+
+            for asset, input, result in zip(batch_assets, batch_inputs, results):
+                try:
+                    detections = self.filter_result(result, self.input_size(input))
+                except Exception as e:
+                    yield asset, None, duration, f"post-processing failed: {e}"
+                    continue
+                yield asset, detections, duration, None
+
+    def iter_detections(self, assets: Iterable[Asset], labels: List[Label], batch_size: int = 8, num_workers: int = 4,
+                        prefetch_batches: int = 2) -> Generator[dict, None, None]:
+        """
+        Yields the filtered detections of each asset as soon as its batch is processed.
+
+        Nothing is written to Picsellia and only the current batch is held in memory, so callers can
+        filter, store or upload the detections incrementally and report progress during long runs.
 
+        Args:
+            assets (Iterable[Asset]): Assets to process, consumed lazily.
+            labels (List[Label]): Picsellia labels to detect.
+            batch_size (int): Number of images sent to the model at once.
+            num_workers (int): Number of threads downloading and decoding images.
+            prefetch_batches (int): Number of batches loaded ahead of the model.
+
+        Yields:
+            dict: Per asset `asset`, `boxes` as (x, y, w, h) lists, `scores`, `labels` (Picsellia Label),
+            `inference_seconds` (share of the batch inference), `elapsed_seconds` (since the first asset)
+            and `error`, which is None unless the asset could not be processed.
+
+        Example:
+            >>> for record in zero_shot_object_detector.iter_detections(dataset_version.list_assets(), labels):
+            ...     print(record["asset"].filename, len(record["boxes"]))
+        """
+        start = time.time()
+        for asset, detections, duration, error in self._detect_assets(
+            assets, labels, batch_size=batch_size, num_workers=num_workers, prefetch_batches=prefetch_batches
+        ):
+            record = {
+                "asset": asset,
+                "boxes": [],
+                "scores": [],
+                "labels": [],
+                "inference_seconds": duration,
+                "elapsed_seconds": time.time() - start,
+                "error": error,
+            }
+            if detections is not None:
+                xywh, label_ids, scores = detections
+                record["boxes"] = xywh.tolist()
+                record["scores"] = scores.tolist()
+                record["labels"] = [labels[label_id] for label_id in label_ids.tolist()]
+            yield record
+
+    def annotate_asset(self, asset: Asset, result: dict, image_size: tuple, labels: List[Label], duration: float):
+        """
+        Filters the detections of one image and stores them as an annotation on `asset`.
+        """
+        # Create annotation if detections exist
+        if len(result["boxes"]) > 0:
+            annotation = asset.create_annotation(duration=duration)
+            rectangles = self.build_rectangles(result, image_size, labels)
             if rectangles:
                 annotation.create_multiple_rectangles(rectangles=rectangles)
 
+    def compare_backends(self, images: List[Image.Image], labels: List[Label], backends: Sequence[str] = BACKENDS) -> dict:
+        """
+        Measures the speed of each backend and the drift of its predictions against eager PyTorch.
+
+        Args:
+            images (List[Image.Image]): Sample images, processed as a single batch.
+            labels (List[Label]): Labels used to compute the scores.
+            backends (Sequence[str]): Backends to compare, unavailable ones are reported with their error.
+
+        Returns:
+            dict: Per backend `seconds_per_image`, `max_box_drift` (in normalized coordinates)
+            and `max_score_drift` over every patch of every image.
+        """
+        model, _ = self.load_model()
+        pixel_values = self.preprocess(images)
+        queries = self.encode_queries(labels).unsqueeze(0).expand(len(images), -1, -1)
+
+        def run(backend):
+            start = time.time()
+            image_feats, pred_boxes = self.load_vision_backend(backend)(pixel_values)
+            elapsed = time.time() - start
+            with torch.no_grad():
+                logits, _ = model.class_predictor(image_feats.to(model.device, queries.dtype), queries)
+            return elapsed, pred_boxes.float().cpu(), torch.sigmoid(logits).float().cpu()
+
+        # The first call of a backend may export it, each one is warmed up before being timed
+        run("eager")
+        _, reference_boxes, reference_scores = run("eager")
+        report = {}
+        for backend in backends:
+            try:
+                run(backend)
+                elapsed, boxes, scores = run(backend)
+            except Exception as e:
+                report[backend] = {"error": str(e)}
+                continue
+            report[backend] = {
+                "seconds_per_image": round(elapsed / len(images), 4),
+                "max_box_drift": float((boxes - reference_boxes).abs().max()),
+                "max_score_drift": float((scores - reference_scores).abs().max()),
+            }
+        return report
+
+    def forward(self, labels: List[Label], asset: Asset) -> str:
+        start = time.time()
+
+        input = self.load_input(asset)
+        result = self.submit(input, labels).result()
+        elapsed = time.time() - start
+
+        self.annotate_asset(asset, result, self.input_size(input), labels, elapsed)
+
         return f"Detection completed. Processing time: {elapsed:.2f} seconds"
 
-   
 
+class ZeroShotDatasetVersionDetectorTool(Tool):
+    name = "zero_shot_dataset_version_detector"
+    description = """
+    This is a tool that pre-annotates a whole DatasetVersion (or a MultiAsset) with zero-shot object detection.
+    Images are processed by batches with the same Owl-ViT model as `zero_shot_object_detector_tool`, and the 
+    predictions are stored as annotations in Picsellia. It returns a report with the number of processed assets,
+    the throughput and the assets that failed with their error.
+    Prefer this tool over `zero_shot_object_detector_tool` whenever more than a few assets must be annotated.
+    Interrupted runs can simply be launched again: assets already annotated with the same labels are skipped.
+    """
+    inputs = {
+        "labels": {
+            "type": "object",
+            "description": "List of Picsellia Label objects to detect",
+        },
+        "assets": {
+            "type": "object",
+            "description": "A Picsellia DatasetVersion or MultiAsset on which to run zero-shot detection",
+        },
+        "batch_size": {
+            "type": "integer",
+            "description": "Number of images sent to the model at once, 8 by default",
+            "nullable": "True"
+        },
+    }
+    output_type = "object"
+
+    def __init__(self, detector: ZeroShotDetectorTool = None, num_workers: int = 4, prefetch_batches: int = 2,
+                 upload_batch_size: int = 1000, num_processes: int = int(os.getenv("OWLV2_NUM_PROCESSES", "1")),
+                 shard_size: int = 256, journal_path: str = DEFAULT_JOURNAL_PATH, progress_every: int = 100, **kwargs):
+        super().__init__(**kwargs)
+        self.detector = detector if detector is not None else ZeroShotDetectorTool()
+        self.upload_batch_size = upload_batch_size
+        self.num_workers = num_workers
+        self.prefetch_batches = prefetch_batches
+        # With several processes, assets are split in shards of `shard_size` dispatched to the workers
+        self.num_processes = num_processes
+        self.shard_size = shard_size
+        # Records the per-asset status of every job, so that interrupted jobs can be resumed
+        self.journal_path = journal_path
+        self.progress_every = progress_every
+
+    def _detect_sharded(self, assets: List[Asset], labels: List[Label], batch_size: int,
+                        stats: PipelineStats) -> Iterator[tuple]:
+        """
+        Same as `ZeroShotDetectorTool._detect_assets`, with the shards of `assets` processed by
+        `num_processes` worker processes, each one running its own model on its share of the CPU cores.
+        """
+        assets_by_id = {str(asset.id): asset for asset in assets}
+        shards = [assets[offset:offset + self.shard_size] for offset in range(0, len(assets), self.shard_size)]
+        label_names = [label.name for label in labels]
+        num_threads = max(1, (os.cpu_count() or 1) // self.num_processes)
+        listed_at = time.time()
+
+        def to_refs(shard: List[Asset]) -> List[AssetRef]:
+            # Resolved when the shard is dispatched: getting the url of an asset may cost a request, not
+            # needed when its image is cached, and presigned urls expire during long runs
+            refresh = time.time() - listed_at > URL_REFRESH_SECONDS
+            refs = []
+            for asset in shard:
+                url = None
+                if not is_asset_cached(asset):
+                    url = asset.reset_url() if refresh else asset.url
+                refs.append(AssetRef(str(asset.id), str(asset.data_id), asset.object_name, url))
+            return refs
+
+        with ProcessPoolExecutor(
+            max_workers=self.num_processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_shard_worker,
+            initargs=(self.detector.config(), num_threads),
+        ) as pool:
+            futures = {}
+            broken = []
+
+            def submit(shard: List[Asset]):
+                # Shards that cannot be dispatched, e.g. once a killed worker broke the pool, are reported
+                # as failed like the ones in flight, so that the detections already made are still uploaded
+                try:
+                    if broken:
+                        raise broken[0]
+                    refs = to_refs(shard)
+                    future = pool.submit(_detect_shard, refs, label_names, batch_size, self.num_workers, self.prefetch_batches)
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool):
+                        broken.append(e)
+                    future = Future()
+                    future.set_exception(e)
+                futures[future] = shard
+
+            # A couple of shards per process are in flight, the next one is dispatched when one completes
+            pending_shards = iter(shards)
+            for shard in itertools.islice(pending_shards, 2 * self.num_processes):
+                submit(shard)
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    shard = futures.pop(future)
+                    try:
+                        records, seconds = future.result()
+                    except Exception as e:
+                        records, seconds = [(str(asset.id), None, 0.0, f"worker failed: {e}") for asset in shard], {}
+                    for stage, stage_seconds in seconds.items():
+                        stats.add(stage, stage_seconds)
+                    for asset_id, detections, duration, error in records:
+                        yield assets_by_id[asset_id], detections, duration, error
+                    next_shard = next(pending_shards, None)
+                    if next_shard is not None:
+                        submit(next_shard)
+
+
+    def forward(self, labels: List[Label], assets: Union[DatasetVersion, MultiAsset], batch_size: int = 8) -> dict:
+        """
+        Runs zero-shot detection on every asset of a DatasetVersion or a MultiAsset.
+
+        Args:
+            labels (List[Label]): Picsellia labels to detect.
+            assets (Union[DatasetVersion, MultiAsset]): The assets to pre-annotate.
+            batch_size (int): Number of images sent to the model at once.
+
+        Returns:
+            dict: A report with `processed`, `skipped` (already annotated by a previous run with the same
+            configuration), `failed`, `failures` (asset id -> error),
+            `elapsed_seconds`, `assets_per_second` and the time spent per stage: `io_seconds`
+            (download and decode, cumulated over the workers), `stall_seconds` (inference waiting
+            for images), `compute_seconds` (inference) and `upload_seconds` (annotation creation), and the
+            number of annotation API requests. With several processes, stage times are cumulated over them.
+            `downloads` holds the statistics of the download client of this process since it started.
+        """
+        # The input is nullable, without a size `batched` would send the whole DatasetVersion at once
+        batch_size = batch_size or 8
+        journal = PreAnnotationJournal(self.detector.job_config(labels), path=self.journal_path)
+        completed = journal.completed()
+
+        # Assets annotated by this job are also tagged in a DatasetVersion, which catches runs that
+        # uploaded annotations but died before updating the journal
+        dataset_version, tag = None, None
+        if isinstance(assets, DatasetVersion):
+            dataset_version = assets
+            tag = dataset_version.get_or_create_asset_tag(f"agent-preannotated-{journal.job_id}")
+            try:
+                completed |= {str(asset.id) for asset in dataset_version.list_assets(tags=[tag])}
+            except NoDataError:
+                # No asset tagged yet
+                pass
+            except Exception as e:
+                logger.warning(f"Could not list the assets tagged {tag.name}, relying on the journal only: {e}")
+            assets = dataset_version.list_assets()
+
+        def on_written(written_assets: List[Asset]):
+            journal.mark_done([str(asset.id) for asset in written_assets])
+            if tag is not None:
+                try:
+                    MultiAsset(dataset_version.connexion, dataset_version.id, written_assets).add_tags(tag)
+                except Exception as e:
+                    logger.warning(f"Could not tag {len(written_assets)} pre-annotated assets: {e}")
+
+        # Annotations of a whole DatasetVersion are uploaded in bulk through COCO imports
+        if dataset_version is not None:
+            writer = BulkAnnotationWriter(dataset_version, max_assets=self.upload_batch_size, on_written=on_written)
+        else:
+            writer = AnnotationWriter(on_written=on_written)
+
+        # Only the assets not completed yet are processed, previously failed ones are retried
+        remaining = [asset for asset in assets if str(asset.id) not in completed]
+        skipped = len(assets) - len(remaining)
+        assets = remaining
+        journal.mark_pending([str(asset.id) for asset in assets])
+
+        start = time.time()
+        stats = PipelineStats()
+        processed = 0
+        failures = {}
+
+        if self.num_processes > 1:
+            detections_by_asset = self._detect_sharded(assets, labels, batch_size, stats)
+        else:
+            detections_by_asset = self.detector._detect_assets(
+                assets, labels, batch_size=batch_size, num_workers=self.num_workers,
+                prefetch_batches=self.prefetch_batches, stats=stats,
+            )
+
+        # The buffered annotations are uploaded and the journal closed even if the run is interrupted,
+        # the assets left pending are processed again by the next run
+        try:
+            for count, (asset, detections, duration, error) in enumerate(detections_by_asset, start=1):
+                if count % self.progress_every == 0:
+                    logger.info(f"{count}/{len(assets)} assets processed ({count / (time.time() - start):.1f} assets/s)")
+                if error is not None:
+                    failures[str(asset.id)] = error
+                    continue
+                with stats.timer("upload"):
+                    writer.add(asset, self.detector.to_rectangles(detections, labels), duration)
+                processed += 1
+        finally:
+            try:
+                with stats.timer("upload"):
+                    writer.close()
+            finally:
+                failures.update(writer.failures)
+                journal.mark_failed(failures)
+                journal.close()
+        processed -= len(writer.failures)
+
+        elapsed = time.time() - start
+        return {
+            "processed": processed,
+            "skipped": skipped,
+            "failed": len(failures),
+            "failures": failures,
+            "elapsed_seconds": round(elapsed, 2),
+            "assets_per_second": round(processed / elapsed, 2) if elapsed > 0 else 0.0,
+            **stats.as_dict(),
+            **writer.report(),
+            "downloads": download_client.stats(),
+        }
+
+
+# Minimal picklable views of Picsellia objects, sent to the shard worker processes
+AssetRef = namedtuple("AssetRef", ["id", "data_id", "object_name", "url"])
+LabelRef = namedtuple("LabelRef", ["name"])
+
+_shard_detector = None
+
+
+def _init_shard_worker(detector_config: dict, num_threads: int):
+    global _shard_detector
+    torch.set_num_threads(num_threads)
+    _shard_detector = ZeroShotDetectorTool(device="cpu", **detector_config)
+
+
+def _detect_shard(refs: List[AssetRef], label_names: List[str], batch_size: int, num_workers: int,
+                  prefetch_batches: int) -> tuple:
+    labels = [LabelRef(name) for name in label_names]
+    stats = PipelineStats()
+    records = [
+        (ref.id, detections, duration, error)
+        for ref, detections, duration, error in _shard_detector._detect_assets(
+            refs, labels, batch_size=batch_size, num_workers=num_workers, prefetch_batches=prefetch_batches, stats=stats
+        )
+    ]
+    return records, stats.seconds
 
 
 zero_shot_object_detector = ZeroShotDetectorTool()
+zero_shot_dataset_version_detector = ZeroShotDatasetVersionDetectorTool(detector=zero_shot_object_detector)
 
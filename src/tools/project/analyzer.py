@@ -1,11 +1,11 @@
-import os
 import torch
 from open_clip import tokenize, load_model
 from sklearn.cluster import KMeans
 from picsellia import Client
-from PIL import Image
 from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
 from tqdm import tqdm
+from utils.image_cache import fetch_asset_bytes
+from utils.images import decode_image
 
 
 
@@ -17,9 +17,6 @@ def compute_clip_embeddings_and_tag_outliers(dataset_version_id, api_token, clip
     client = Client(api_token=api_token)
     dataset_version = client.DatasetVersion(id=dataset_version_id)
 
-    # Download dataset assets
-    dataset_version.download()
-
     # Get the list of labels and determine the number of clusters
     labels = dataset_version.list_labels()
     num_clusters = len(labels)
@@ -32,8 +29,8 @@ def compute_clip_embeddings_and_tag_outliers(dataset_version_id, api_token, clip
     embeddings = []
     asset_ids = []
     for asset in tqdm(dataset_version.list_assets()):
-        image_path = os.path.join(dataset_version.name, asset.filename)
-        image = preprocess(Image.open(image_path)).unsqueeze(0).to(device)
+        # Read from the image cache shared with the other tools, downloaded on a miss
+        image = preprocess(decode_image(fetch_asset_bytes(asset))).unsqueeze(0).to(device)
         with torch.no_grad():
             embedding = model.encode_image(image)
         embeddings.append(embedding.cpu().numpy())
@@ -4,6 +4,7 @@ from markdownify import markdownify
 from requests.exceptions import RequestException
 from smolagents import tool, Tool
 from typing import List
+from utils.downloads import download_client
 # from langchain.docstore.document import Document
 # from langchain.text_splitter import RecursiveCharacterTextSplitter
 # # from langchain_community.retrievers import BM25Retriever
@@ -97,8 +98,8 @@ class PicselliaDocumentationBrowser(Tool):
         """
         try:
             # Send a GET request to the URL
-            response = requests.get("https://documentation.picsellia.com/reference/client")
-            response.raise_for_status()  # Raise an exception for bad status codes
+            # Raises an exception for bad status codes, after retrying transient ones
+            response = download_client.get("https://documentation.picsellia.com/reference/client")
 
             # Convert the HTML content to Markdown
             markdown_content = markdownify(response.text).strip()
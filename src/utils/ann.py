@@ -0,0 +1,281 @@
+import logging
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Returns the column indices of the `k` highest scores of each row, sorted by decreasing score."""
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k] if k < scores.shape[1] else np.tile(np.arange(k), (len(scores), 1))
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(top, order, axis=1)
+
+
+class IVFIndex:
+    """
+    NumPy inverted-file index for approximate nearest-neighbour search on L2-normalized embeddings.
+
+    Vectors are clustered around `nlist` k-means centroids and stored contiguously per cluster. A
+    query only scores the vectors of its `nprobe` closest clusters, so searching n vectors costs
+    about n * nprobe / nlist dot products instead of n. Similarity is the inner product, i.e. the
+    cosine similarity of normalized embeddings.
+
+    Vectors are identified by string ids (e.g. asset ids). Added vectors are assigned to the
+    existing centroids, and removed ones are masked, both being applied to the contiguous
+    layout on the next search.
+    """
+
+    def __init__(self, dim: int, nlist: Optional[int] = None, nprobe: int = 8, seed: int = 0):
+        self.dim = dim
+        # Chosen at build time as ~sqrt(n) when not given
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.seed = seed
+        self.centroids: Optional[np.ndarray] = None
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.ids = np.zeros(0, dtype=object)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self._pending = []
+        self._removed = set()
+
+    def __len__(self) -> int:
+        return len(self.ids) + sum(len(ids) for _, ids in self._pending) - len(self._removed)
+
+    def _train(self, vectors: np.ndarray, iterations: int = 10, sample_size: int = 65536):
+        rng = np.random.default_rng(self.seed)
+        nlist = self.nlist or max(1, int(np.sqrt(len(vectors))))
+        nlist = min(nlist, len(vectors))
+        sample = vectors[rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            counts = np.bincount(assignments, minlength=nlist)
+            # Empty clusters keep their previous centroid
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+            centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+        self.centroids = centroids.astype(np.float32)
+        self.nlist = nlist
+
+    def _assign(self, vectors: np.ndarray, block_size: int = 65536) -> np.ndarray:
+        return np.concatenate([
+            np.argmax(vectors[start:start + block_size] @ self.centroids.T, axis=1)
+            for start in range(0, len(vectors), block_size)
+        ]) if len(vectors) else np.zeros(0, dtype=np.int64)
+
+    def build(self, vectors: np.ndarray, ids: Sequence[str]) -> "IVFIndex":
+        """Trains the centroids on `vectors` and indexes them, replacing any previous content."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self._train(vectors)
+        self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+        self.ids = np.zeros(0, dtype=object)
+        self.offsets = np.zeros(self.nlist + 1, dtype=np.int64)
+        self._pending = [(vectors, np.asarray(ids, dtype=object))]
+        self._removed = set()
+        self._compact()
+        return self
+
+    def add(self, vectors: np.ndarray, ids: Sequence[str]):
+        """Indexes more vectors, assigned to the existing centroids (the first call builds the index)."""
+        if self.centroids is None:
+            self.build(vectors, ids)
+            return
+        ids = np.asarray(ids, dtype=object)
+        self._removed -= set(ids)
+        self._pending.append((np.ascontiguousarray(vectors, dtype=np.float32), ids))
+
+    def remove(self, ids: Sequence[str]):
+        self._removed |= set(ids)
+
+    def indexed_ids(self) -> set:
+        self._compact()
+        return set(self.ids)
+
+    def _compact(self):
+        if not self._pending and not self._removed:
+            return
+        vectors = np.concatenate([self.vectors] + [vectors for vectors, _ in self._pending])
+        ids = np.concatenate([self.ids] + [ids for _, ids in self._pending])
+        lists = np.concatenate([np.repeat(np.arange(self.nlist), np.diff(self.offsets))]
+                               + [self._assign(vectors) for vectors, _ in self._pending])
+        # The last occurrence of an id wins, earlier ones and removed ids are dropped
+        _, last = np.unique(ids[::-1], return_index=True)
+        keep = np.zeros(len(ids), dtype=bool)
+        keep[len(ids) - 1 - last] = True
+        if self._removed:
+            keep &= ~np.isin(ids, np.array(list(self._removed), dtype=object))
+
+        order = np.argsort(lists[keep], kind="stable")
+        self.vectors = vectors[keep][order]
+        self.ids = ids[keep][order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(lists[keep], minlength=self.nlist))])
+        self._pending = []
+        self._removed = set()
+
+    def search(self, queries: np.ndarray, k: int = 10, nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the `k` nearest neighbours of each query.
+
+        Queries are processed as a batch: each probed cluster is scored against all the queries
+        probing it with a single matrix product, and its k best vectors are kept per query.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: `(scores, ids)` of shape (len(queries), k), sorted by
+            decreasing similarity. Missing neighbours have a -inf score and a None id.
+        """
+        self._compact()
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if self.centroids is None or not len(self.ids):
+            return np.full((len(queries), k), -np.inf, dtype=np.float32), np.full((len(queries), k), None, dtype=object)
+
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        probes = _top_k(queries @ self.centroids.T, nprobe)
+        # Top k of each probed cluster, merged once all clusters are scored
+        candidate_scores = np.full((len(queries), nprobe, k), -np.inf, dtype=np.float32)
+        candidate_rows = np.full((len(queries), nprobe, k), -1, dtype=np.int64)
+
+        flat_probes = probes.ravel()
+        order = np.argsort(flat_probes, kind="stable")
+        clusters, starts = np.unique(flat_probes[order], return_index=True)
+        for cluster, group in zip(clusters, np.split(order, starts[1:])):
+            start, end = self.offsets[cluster], self.offsets[cluster + 1]
+            if start == end:
+                continue
+            query_rows, probe_slots = np.divmod(group, nprobe)
+            scores = queries[query_rows] @ self.vectors[start:end].T
+            top = _top_k(scores, k)
+            candidate_scores[query_rows, probe_slots, :top.shape[1]] = np.take_along_axis(scores, top, axis=1)
+            candidate_rows[query_rows, probe_slots, :top.shape[1]] = top + start
+
+        candidate_scores = candidate_scores.reshape(len(queries), -1)
+        candidate_rows = candidate_rows.reshape(len(queries), -1)
+        top = _top_k(candidate_scores, k)
+        best_scores = np.take_along_axis(candidate_scores, top, axis=1)
+        best_rows = np.take_along_axis(candidate_rows, top, axis=1)
+        ids = np.where(best_rows >= 0, self.ids[np.maximum(best_rows, 0)], None)
+        return best_scores, ids
+
+    def save(self, path: str):
+        self._compact()
+        np.savez(
+            path, centroids=self.centroids if self.centroids is not None else np.zeros((0, self.dim), np.float32),
+            vectors=self.vectors, ids=self.ids.astype(str), offsets=self.offsets,
+            params=np.array([self.dim, self.nlist or 0, self.nprobe, self.seed]),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path) as arrays:
+            dim, nlist, nprobe, seed = (int(value) for value in arrays["params"])
+            index = cls(dim, nlist=nlist or None, nprobe=nprobe, seed=seed)
+            if len(arrays["centroids"]):
+                index.centroids = arrays["centroids"]
+            index.vectors = arrays["vectors"]
+            index.ids = arrays["ids"].astype(object)
+            index.offsets = arrays["offsets"]
+        return index
+
+
+class FaissIndex:
+    """
+    Same interface as `IVFIndex`, backed by a FAISS `IndexIVFFlat` on inner products.
+
+    FAISS only knows integer ids, they are mapped to the string ids by `ids`.
+    """
+
+    def __init__(self, dim: int, nlist: Optional[int] = None, nprobe: int = 8):
+        import faiss
+
+        self.faiss = faiss
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.index = None
+        self.ids = []
+        self.rows = {}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def build(self, vectors: np.ndarray, ids: Sequence[str]) -> "FaissIndex":
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        nlist = min(self.nlist or max(1, int(np.sqrt(len(vectors)))), len(vectors))
+        self.index = self.faiss.IndexIVFFlat(self.faiss.IndexFlatIP(self.dim), self.dim, nlist,
+                                             self.faiss.METRIC_INNER_PRODUCT)
+        self.index.train(vectors)
+        self.ids, self.rows = [], {}
+        self.add(vectors, ids)
+        return self
+
+    def add(self, vectors: np.ndarray, ids: Sequence[str]):
+        if self.index is None:
+            self.build(vectors, ids)
+            return
+        self.remove([id for id in ids if id in self.rows])
+        rows = np.arange(len(self.ids), len(self.ids) + len(ids), dtype=np.int64)
+        self.ids.extend(ids)
+        self.rows.update({id: int(row) for id, row in zip(ids, rows)})
+        self.index.add_with_ids(np.ascontiguousarray(vectors, dtype=np.float32), rows)
+
+    def indexed_ids(self) -> set:
+        return set(self.rows)
+
+    def remove(self, ids: Sequence[str]):
+        rows = np.array([self.rows.pop(id) for id in ids if id in self.rows], dtype=np.int64)
+        if len(rows):
+            self.index.remove_ids(rows)
+
+    def search(self, queries: np.ndarray, k: int = 10, nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        queries = np.ascontiguousarray(np.atleast_2d(queries), dtype=np.float32)
+        if self.index is None:
+            return np.full((len(queries), k), -np.inf, np.float32), np.full((len(queries), k), None, dtype=object)
+        self.index.nprobe = nprobe or self.nprobe
+        scores, rows = self.index.search(queries, k)
+        ids = np.array([[self.ids[row] if row >= 0 else None for row in query_rows] for query_rows in rows], dtype=object)
+        return np.where(rows >= 0, scores, -np.inf), ids
+
+    def save(self, path: str):
+        self.faiss.write_index(self.index, path)
+        np.save(f"{path}.ids.npy", np.array(self.ids, dtype=str))
+        # Removed rows stay in `ids` to keep the row numbers, only live ones are kept in `rows`
+        np.save(f"{path}.alive.npy", np.array([self.rows.get(id) == row for row, id in enumerate(self.ids)]))
+
+    @classmethod
+    def load(cls, path: str) -> "FaissIndex":
+        import faiss
+
+        faiss_index = faiss.read_index(path)
+        index = cls(faiss_index.d, nlist=faiss_index.nlist)
+        index.index = faiss_index
+        index.ids = list(np.load(f"{path}.ids.npy"))
+        alive = np.load(f"{path}.alive.npy")
+        index.rows = {id: row for row, (id, is_alive) in enumerate(zip(index.ids, alive)) if is_alive}
+        return index
+
+
+def create_index(dim: int, backend: str = "auto", **kwargs):
+    """
+    Returns an empty ANN index, `FaissIndex` when `backend` is "faiss" or "auto" with FAISS
+    installed, `IVFIndex` otherwise.
+    """
+    if backend in ("auto", "faiss"):
+        try:
+            return FaissIndex(dim, **kwargs)
+        except ImportError:
+            if backend == "faiss":
+                raise ImportError("The faiss backend requires `faiss-cpu` (or `faiss-gpu`) to be installed.")
+    elif backend != "numpy":
+        raise ValueError(f"Unknown ANN backend {backend}, expected auto, numpy or faiss.")
+    return IVFIndex(dim, **kwargs)
+
+
+def load_index(path: str):
+    """Loads an index saved by `IVFIndex.save` (.npz) or `FaissIndex.save`."""
+    if path.endswith(".npz"):
+        return IVFIndex.load(path)
+    return FaissIndex.load(path)
@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Callable, List, Optional, Tuple
+
+from picsellia import Asset, DatasetVersion, Label
+from picsellia.exceptions import ResourceNotFoundError
+from picsellia.types.enums import ImportAnnotationMode
+
+logger = logging.getLogger(__name__)
+
+Rectangle = Tuple[int, int, int, int, Label]
+
+
+class AnnotationWriter:
+    """
+    Writes the rectangles of each asset as soon as they are added, with two API calls per asset.
+
+    `on_written` is called with the assets whose annotations are stored in Picsellia, including the
+    assets without any rectangle, once they are.
+    """
+
+    def __init__(self, on_written: Optional[Callable[[List[Asset]], None]] = None):
+        self.failures = {}
+        self.requests = 0
+        self.on_written = on_written
+
+    def _written(self, assets: List[Asset]):
+        if self.on_written is not None and assets:
+            self.on_written(assets)
+
+    def add(self, asset: Asset, rectangles: List[Rectangle], duration: float = 0.0):
+        if not rectangles:
+            self._written([asset])
+            return
+        try:
+            annotation = asset.create_annotation(duration=duration)
+            annotation.create_multiple_rectangles(rectangles=rectangles)
+        except Exception as e:
+            self.failures[str(asset.id)] = f"annotation failed: {e}"
+            return
+        finally:
+            self.requests += 2
+        self._written([asset])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def report(self) -> dict:
+        return {"annotation_requests": self.requests, "annotation_failures": len(self.failures)}
+
+
+class BulkAnnotationWriter(AnnotationWriter):
+    """
+    Buffers rectangles of many assets and uploads them with a single COCO import per flush.
+
+    The buffer is flushed when it holds `max_assets` assets or when its oldest entry is older than
+    `max_seconds`.
+
+    Imports use the KEEP mode by default: like `AnnotationWriter`, which creates annotations, they
+    never delete nor modify an existing annotation, where the Picsellia default (REPLACE) would
+    delete the annotation of every asset of the file. It also makes re-importing a file whose
+    previous import failed after being partially applied harmless.
+
+    A failed import may have been partially applied, so the buffered assets are checked and only
+    those still without annotation are imported again, `max_retries` times with exponential
+    backoff. The assets still without annotation then fall back to per-asset writes, so that a
+    single faulty asset only fails on its own; the assets whose state cannot be checked are
+    reported as failed rather than written twice.
+    """
+
+    def __init__(self, dataset_version: DatasetVersion, max_assets: int = 1000, max_seconds: float = 60.0,
+                 max_retries: int = 3, backoff: float = 2.0, on_written: Optional[Callable[[List[Asset]], None]] = None,
+                 import_mode: str = ImportAnnotationMode.KEEP):
+        super().__init__(on_written=on_written)
+        self.dataset_version = dataset_version
+        self.max_assets = max_assets
+        self.max_seconds = max_seconds
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.import_mode = import_mode
+        self._buffer: List[Tuple[Asset, List[Rectangle]]] = []
+        self._buffer_start = None
+
+    def add(self, asset: Asset, rectangles: List[Rectangle], duration: float = 0.0):
+        # Assets without rectangles are buffered too, so that they are only reported written on flush
+        if not self._buffer:
+            self._buffer_start = time.time()
+        self._buffer.append((asset, rectangles))
+        if len(self._buffer) >= self.max_assets or time.time() - self._buffer_start >= self.max_seconds:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        buffer, self._buffer = self._buffer, []
+        # Assets without rectangles have nothing to import
+        self._written([asset for asset, rectangles in buffer if not rectangles])
+        pending = [(asset, rectangles) for asset, rectangles in buffer if rectangles]
+        unknown = {}
+
+        for attempt in range(self.max_retries + 1):
+            if not pending:
+                return
+            try:
+                self._import(pending)
+            except Exception as e:
+                logger.warning(f"COCO import of {len(pending)} assets failed (attempt {attempt + 1}): {e}")
+                annotated, pending, unknown = self._check_annotated(pending)
+                self._written(annotated)
+                pending += list(unknown.values())
+                if pending and attempt < self.max_retries:
+                    time.sleep(self.backoff ** attempt)
+                continue
+            self._written([asset for asset, _ in pending])
+            return
+
+        # Only the assets known to have no annotation are written one by one
+        fallback = AnnotationWriter(on_written=self.on_written)
+        for asset, rectangles in pending:
+            if str(asset.id) in unknown:
+                self.failures[str(asset.id)] = "annotation failed: COCO import failed and its outcome could not be checked"
+            else:
+                fallback.add(asset, rectangles)
+        self.requests += fallback.requests
+        self.failures.update(fallback.failures)
+
+    def _check_annotated(self, buffer: List[Tuple[Asset, List[Rectangle]]]) -> tuple:
+        """
+        Splits buffered assets after a failed import into the assets that have an annotation, the
+        entries of the assets without one and the entries, by asset id, whose state is unknown.
+        """
+        annotated, missing, unknown = [], [], {}
+        for asset, rectangles in buffer:
+            self.requests += 1
+            try:
+                asset.get_annotation()
+            except ResourceNotFoundError:
+                missing.append((asset, rectangles))
+                continue
+            except Exception as e:
+                logger.warning(f"Could not check the annotation of asset {asset.id}: {e}")
+                unknown[str(asset.id)] = (asset, rectangles)
+                continue
+            annotated.append(asset)
+        return annotated, missing, unknown
+
+    def _import(self, buffer: List[Tuple[Asset, List[Rectangle]]]):
+        fd, path = tempfile.mkstemp(suffix=".json")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(to_coco(buffer), f)
+            self.requests += 1
+            job = self.dataset_version.import_annotations_coco_file(
+                file_path=path, mode=self.import_mode, force_create_label=False, fail_on_asset_not_found=False
+            )
+            if hasattr(job, "wait_for_done"):
+                job.wait_for_done()
+        finally:
+            os.remove(path)
+
+
+def to_coco(buffer: List[Tuple[Asset, List[Rectangle]]]) -> dict:
+    """Converts buffered rectangles to a COCO detection dict, images are matched by filename on import."""
+    categories, images, annotations = {}, [], []
+    for image_id, (asset, rectangles) in enumerate(buffer, start=1):
+        images.append({"id": image_id, "file_name": asset.filename, "width": asset.width, "height": asset.height})
+        for x, y, w, h, label in rectangles:
+            category_id = categories.setdefault(label.name, len(categories) + 1)
+            annotations.append({
+                "id": len(annotations) + 1,
+                "image_id": image_id,
+                "category_id": category_id,
+                "bbox": [x, y, w, h],
+                "area": w * h,
+                "iscrowd": 0,
+            })
+    return {
+        "images": images,
+        "annotations": annotations,
+        "categories": [{"id": category_id, "name": name} for name, category_id in categories.items()],
+    }
@@ -0,0 +1,142 @@
+import copy
+import logging
+import os
+import re
+from typing import Callable, Tuple
+
+import torch
+
+from utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("eager", "torchscript", "onnx", "int8")
+BACKEND_CACHE_DIR = os.getenv("OWLV2_BACKEND_CACHE_DIR", os.path.expanduser("~/.cache/cv-interns/backends"))
+
+VisionBackend = Callable[[torch.Tensor], Tuple[torch.Tensor, torch.Tensor]]
+
+_loaded_backends = LRUCache(maxsize=4)
+
+
+class Owlv2VisionHead(torch.nn.Module):
+    """
+    The label-independent part of OWLv2: vision backbone and box head.
+
+    Takes `pixel_values` and returns `(image_feats, pred_boxes)`, of shapes
+    (batch, num_patches, hidden_size) and (batch, num_patches, 4).
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        feature_map = self.model.image_embedder(pixel_values=pixel_values)[0]
+        batch_size, height, width, hidden_size = feature_map.shape
+        image_feats = feature_map.reshape(batch_size, height * width, hidden_size)
+        pred_boxes = self.model.box_predictor(image_feats, feature_map)
+        return image_feats, pred_boxes
+
+
+def _artifact_path(cache_dir: str, model_id: str, backend: str, extension: str) -> str:
+    directory = os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", model_id))
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{backend}-torch{torch.__version__}.{extension}")
+
+
+def _cpu_head(model) -> Owlv2VisionHead:
+    # Converted backends are CPU only, the shared model is copied so it is left untouched
+    head = Owlv2VisionHead(copy.deepcopy(model).to("cpu").float())
+    head.eval()
+    return head
+
+
+def _trace(head: torch.nn.Module, path: str, image_size: int) -> torch.jit.ScriptModule:
+    example = torch.zeros(1, 3, image_size, image_size)
+    with torch.no_grad():
+        traced = torch.jit.trace(head, example, check_trace=False)
+    traced = torch.jit.freeze(traced.eval())
+    torch.jit.save(traced, path)
+    return traced
+
+
+def _load_torchscript(model, model_id: str, backend: str, image_size: int, cache_dir: str) -> VisionBackend:
+    path = _artifact_path(cache_dir, model_id, backend, "pt")
+    if os.path.exists(path):
+        module = torch.jit.load(path, map_location="cpu")
+    else:
+        logger.info(f"Exporting {model_id} to {backend} in {path}")
+        head = _cpu_head(model)
+        if backend == "int8":
+            # Dynamic quantization of the linear layers, which hold most of the ViT compute
+            head = torch.ao.quantization.quantize_dynamic(head, {torch.nn.Linear}, dtype=torch.qint8)
+        module = _trace(head, path, image_size)
+
+    def run(pixel_values: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        with torch.no_grad():
+            return module(pixel_values.to("cpu", torch.float32))
+
+    return run
+
+
+def _load_onnx(model, model_id: str, image_size: int, cache_dir: str) -> VisionBackend:
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("The onnx backend requires onnxruntime, install it with `pip install onnxruntime`.")
+
+    path = _artifact_path(cache_dir, model_id, "onnx", "onnx")
+    if not os.path.exists(path):
+        logger.info(f"Exporting {model_id} to onnx in {path}")
+        tmp_path = f"{path}.tmp"
+        with torch.no_grad():
+            torch.onnx.export(
+                _cpu_head(model),
+                torch.zeros(1, 3, image_size, image_size),
+                tmp_path,
+                input_names=["pixel_values"],
+                output_names=["image_feats", "pred_boxes"],
+                dynamic_axes={"pixel_values": {0: "batch"}, "image_feats": {0: "batch"}, "pred_boxes": {0: "batch"}},
+                opset_version=17,
+            )
+        os.replace(tmp_path, path)
+
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+    def run(pixel_values: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        image_feats, pred_boxes = session.run(None, {"pixel_values": pixel_values.to("cpu", torch.float32).numpy()})
+        return torch.from_numpy(image_feats), torch.from_numpy(pred_boxes)
+
+    return run
+
+
+def load_vision_backend(model, model_id: str, backend: str = "eager", image_size: int = 960,
+                        cache_dir: str = BACKEND_CACHE_DIR) -> VisionBackend:
+    """
+    Returns a function running the OWLv2 vision backbone and box head with the given backend.
+
+    Backends:
+        - `eager`: the PyTorch model as is, on its device.
+        - `torchscript`: traced and frozen TorchScript module, CPU.
+        - `onnx`: ONNX Runtime session, CPU. Requires `onnxruntime`.
+        - `int8`: linear layers dynamically quantized to int8, traced to TorchScript, CPU.
+
+    Converted models are exported once to `cache_dir` and loaded from there afterwards.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}.")
+    if backend == "eager":
+        head = Owlv2VisionHead(model)
+
+        def run(pixel_values: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+            with torch.no_grad():
+                return head(pixel_values)
+
+        return run
+
+    def load() -> VisionBackend:
+        if backend == "onnx":
+            return _load_onnx(model, model_id, image_size, cache_dir)
+        return _load_torchscript(model, model_id, backend, image_size, cache_dir)
+
+    return _loaded_backends.get_or_compute((model_id, backend, image_size, cache_dir), load)
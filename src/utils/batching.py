@@ -0,0 +1,138 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, List
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    Groups the items submitted concurrently by several threads into batches for `batch_fn`.
+
+    A batch is run as soon as it holds `max_batch_size` items or when its first item has waited
+    `max_wait_ms`. `batch_fn` receives a list of items and must return one result per item.
+    The worker thread is started on demand and stops after `idle_seconds` without requests,
+    then calls `on_idle`. A batcher keeps working when submitted to after it stopped.
+    """
+
+    def __init__(self, batch_fn: Callable[[List[Any]], List[Any]], max_batch_size: int = 8,
+                 max_wait_ms: float = 10.0, idle_seconds: float = 30.0, on_idle: Callable[[], None] = None):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.idle_seconds = idle_seconds
+        self.on_idle = on_idle
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def submit(self, item: Any) -> Future:
+        return self.submit_many([item])[0]
+
+    def submit_many(self, items: List[Any]) -> List[Future]:
+        """Queues `items` at once, so that they are not split by the worker picking up the first ones."""
+        futures = [Future() for _ in items]
+        with self._lock:
+            for item, future in zip(items, futures):
+                self._queue.put((item, future))
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+        return futures
+
+    def __call__(self, item: Any) -> Any:
+        return self.submit(item).result()
+
+    def _next_batch(self) -> list:
+        try:
+            batch = [self._queue.get(timeout=self.idle_seconds)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                with self._lock:
+                    # Items submitted while timing out are served before stopping
+                    stopped = self._queue.empty()
+                    if stopped:
+                        self._worker = None
+                if stopped:
+                    if self.on_idle is not None:
+                        self.on_idle()
+                    return
+                continue
+
+            items = [item for item, _ in batch]
+            try:
+                results = list(self.batch_fn(items))
+                if len(results) != len(items):
+                    # Unresolved futures would block their callers forever
+                    raise RuntimeError(f"Expected {len(items)} results from the batch function, got {len(results)}.")
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+class InferenceService:
+    """
+    Process-wide set of micro-batchers, so that concurrent tool calls running the same model
+    share batched forward passes instead of each running a batch of one.
+
+    Requests can only be batched together when they run the same function with the same
+    parameters (e.g. the same text queries), which is what the `key` of a batcher identifies.
+    Batchers are dropped when their worker stops, releasing their `batch_fn` and what it holds.
+    """
+
+    def __init__(self, max_batch_size: int = 8, max_wait_ms: float = 10.0):
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._batchers = {}
+        self._lock = threading.Lock()
+
+    def batcher(self, key: Hashable, batch_fn: Callable[[List[Any]], List[Any]],
+                max_batch_size: int = None) -> MicroBatcher:
+        """
+        Returns the batcher of `key`, created with `batch_fn` on first use, running batches of up to
+        `max_batch_size` items (`self.max_batch_size` by default).
+        """
+        with self._lock:
+            if key not in self._batchers:
+                batcher = MicroBatcher(batch_fn, max_batch_size or self.max_batch_size, self.max_wait_ms,
+                                       on_idle=lambda: self._remove(key, batcher))
+                self._batchers[key] = batcher
+            return self._batchers[key]
+
+    def _remove(self, key: Hashable, batcher: MicroBatcher):
+        with self._lock:
+            # A newer batcher may have replaced it, if it was submitted to again after stopping
+            if self._batchers.get(key) is batcher:
+                del self._batchers[key]
+
+    def submit(self, key: Hashable, batch_fn: Callable[[List[Any]], List[Any]], item: Any,
+               max_batch_size: int = None) -> Future:
+        return self.batcher(key, batch_fn, max_batch_size).submit(item)
+
+    def submit_many(self, key: Hashable, batch_fn: Callable[[List[Any]], List[Any]], items: List[Any],
+                    max_batch_size: int = None) -> List[Future]:
+        return self.batcher(key, batch_fn, max_batch_size).submit_many(items)
+
+
+inference_service = InferenceService()
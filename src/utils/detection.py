@@ -0,0 +1,48 @@
+from typing import Tuple
+
+import numpy as np
+
+SCORE_THRESHOLD = 0.15
+MIN_AREA_RATIO = 0.5
+MAX_AREA_RATIO = 2.0
+
+
+def filter_detections(boxes: np.ndarray, scores: np.ndarray, label_ids: np.ndarray, image_size: Tuple[int, int],
+                      score_threshold: float = SCORE_THRESHOLD, min_area_ratio: float = MIN_AREA_RATIO,
+                      max_area_ratio: float = MAX_AREA_RATIO) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Filters raw detections of one image and converts them to Picsellia rectangles, on whole arrays.
+
+    Boxes scoring above `score_threshold` are truncated to integers and clipped to the image. Boxes
+    whose clipped area is outside [min_area_ratio, max_area_ratio] times the average area of all
+    raw boxes are dropped, as they are usually duplicates of a whole group or of a part of an object.
+
+    Args:
+        boxes (np.ndarray): (N, 4) boxes as (x1, y1, x2, y2) in pixels.
+        scores (np.ndarray): (N,) confidence scores.
+        label_ids (np.ndarray): (N,) index of the query of each box.
+        image_size (Tuple[int, int]): (width, height) of the image.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: The kept (M, 4) integer boxes as (x, y, w, h),
+        their label ids and their scores.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    label_ids = np.asarray(label_ids, dtype=np.int64).reshape(-1)
+    if len(boxes) == 0:
+        return np.zeros((0, 4), dtype=np.int64), label_ids, scores
+
+    # Average area of the raw boxes, before any filtering
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    avg_area = areas.mean()
+
+    image_width, image_height = image_size
+    upper = np.array([image_width - 1, image_height - 1, image_width - 1, image_height - 1])
+    corners = np.clip(np.trunc(boxes).astype(np.int64), 0, upper)
+    xywh = np.concatenate([corners[:, :2], corners[:, 2:] - corners[:, :2]], axis=1)
+    clipped_areas = xywh[:, 2] * xywh[:, 3]
+
+    keep = np.round(scores, 3) > score_threshold
+    keep &= (clipped_areas >= min_area_ratio * avg_area) & (clipped_areas <= max_area_ratio * avg_area)
+    return xywh[keep], label_ids[keep], scores[keep]
@@ -0,0 +1,103 @@
+import os
+import tempfile
+import threading
+from typing import Optional
+
+
+class DiskCache:
+    """
+    Size-capped content-addressed cache of byte blobs on disk, shared by threads and processes.
+
+    Writes are atomic (temporary file then rename), so readers never see partial entries. Reads
+    refresh the modification time of the entry, and when the cache grows over `max_bytes` the
+    least recently used entries are removed until it is back under 90% of the budget.
+
+    Creating a cache touches nothing on disk: the directory is created by the first write, and the
+    usage of a cache holding many files is only measured by the first write of the process.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size: Optional[int] = None
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def _entries(self):
+        """Yields `(path, stat)` of every committed entry, skipping the ones removed meanwhile."""
+        if not os.path.isdir(self.root):
+            return
+        for directory in os.scandir(self.root):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    yield entry.path, entry.stat()
+                except FileNotFoundError:
+                    pass
+
+    def _disk_usage(self) -> int:
+        return sum(stat.st_size for _, stat in self._entries())
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # Missing, or evicted by another process in the meantime
+            return None
+        return data
+
+    def get_path(self, key: str) -> Optional[str]:
+        """Returns the path of the entry after refreshing it, or None if it is not cached."""
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key: str, data: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            if self._size is None:
+                # Includes `data`, written above
+                self._size = self._disk_usage()
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Other processes write to the same directory, the actual usage is measured again
+        entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime)
+        size = sum(stat.st_size for _, stat in entries)
+        target = 0.9 * self.max_bytes
+        for path, stat in entries:
+            if size <= target:
+                break
+            size -= stat.st_size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._size = size
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Transient errors of object storages and rate limits, retried with exponential backoff
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class DownloadClient:
+    """
+    Process-wide HTTP client for image and asset downloads.
+
+    Connections are kept alive in a pool of `pool_size` connections per host, so that consecutive
+    downloads from the same storage skip the TCP and TLS handshakes. At most `max_per_host`
+    requests run concurrently against a host, every request has a (connect, read) `timeout`, and
+    connection errors and transient statuses are retried `max_retries` times with exponential
+    backoff (`backoff` * 2 ** retry seconds).
+    """
+
+    def __init__(self, pool_size: int = 16, max_per_host: int = 8, timeout: Tuple[float, float] = (5.0, 30.0),
+                 max_retries: int = 3, backoff: float = 0.5):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.pool_size = 0
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+        self._host_slots: Dict[str, threading.BoundedSemaphore] = {}
+        self._stats = defaultdict(float)
+        self.reserve(pool_size)
+
+    def reserve(self, num_workers: int):
+        """Grows the connection pool so that `num_workers` threads can download concurrently."""
+        with self._lock:
+            if num_workers <= self.pool_size:
+                return
+            self.pool_size = num_workers
+            retry = Retry(
+                total=self.max_retries, backoff_factor=self.backoff, status_forcelist=RETRY_STATUSES,
+                allowed_methods=("GET", "HEAD"), raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=num_workers, pool_maxsize=num_workers, max_retries=retry)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+
+    @contextmanager
+    def _host_slot(self, url: str):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            slot = self._host_slots[host]
+        with slot:
+            yield
+
+    def _record(self, **values):
+        with self._lock:
+            for key, value in values.items():
+                self._stats[key] += value
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """GETs `url` and raises `requests.HTTPError` if its final status is an error."""
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        try:
+            with self._host_slot(url):
+                response = self.session.get(url, **kwargs)
+                # Reads the body while holding the host slot
+                content = response.content
+            response.raise_for_status()
+        except requests.RequestException:
+            self._record(requests=1, errors=1, seconds=time.perf_counter() - start)
+            raise
+
+        history = getattr(getattr(response.raw, "retries", None), "history", None) or ()
+        self._record(requests=1, retries=len(history), bytes=len(content), seconds=time.perf_counter() - start)
+        return response
+
+    def get_bytes(self, url: str) -> bytes:
+        return self.get(url).content
+
+    def stats(self) -> dict:
+        """Returns the number of `requests`, `errors`, `retries` and `bytes`, and the mean latency."""
+        with self._lock:
+            stats = dict(self._stats)
+        requests_count = int(stats.get("requests", 0))
+        return {
+            "requests": requests_count,
+            "errors": int(stats.get("errors", 0)),
+            "retries": int(stats.get("retries", 0)),
+            "bytes": int(stats.get("bytes", 0)),
+            "mean_latency_seconds": stats.get("seconds", 0.0) / requests_count if requests_count else 0.0,
+        }
+
+
+download_client = DownloadClient(
+    pool_size=int(os.getenv("DOWNLOAD_POOL_SIZE", "16")),
+    max_per_host=int(os.getenv("DOWNLOAD_MAX_PER_HOST", "8")),
+    timeout=(5.0, float(os.getenv("DOWNLOAD_TIMEOUT_SECONDS", "30"))),
+    max_retries=int(os.getenv("DOWNLOAD_MAX_RETRIES", "3")),
+)
@@ -0,0 +1,143 @@
+import json
+import os
+import re
+import tempfile
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+
+class EmbeddingStore:
+    """
+    Persistent float16 embeddings of the assets of one DatasetVersion, for one model.
+
+    Embeddings are rows of a memory-mapped matrix, indexed by Data id so that assets pointing
+    to the same Data share a row, and a separate index maps asset ids to Data ids. `sync` drops
+    the rows of the assets removed from the version and returns the assets that still need to be
+    embedded, so that updating the store costs time proportional to the change. Rows freed by
+    removed assets are reused by the next additions, and the matrix doubles its capacity when full.
+
+    The store is reset when `model_fingerprint` changes. It expects a single writer at a time,
+    changes are only persisted by `save`, which replaces the index atomically.
+
+    Layout:
+        <root>/<dataset_version_id>/embeddings.npy
+        <root>/<dataset_version_id>/index.json
+    """
+
+    def __init__(self, root: str, dataset_version_id: str, model_fingerprint: str):
+        self.root = os.path.join(root, re.sub(r"[^A-Za-z0-9_.-]", "_", str(dataset_version_id)))
+        self.model_fingerprint = model_fingerprint
+        os.makedirs(self.root, exist_ok=True)
+        self._matrix: Optional[np.memmap] = None
+        self.rows: Dict[str, int] = {}
+        self.assets: Dict[str, str] = {}
+        self.free: List[int] = []
+
+        index = self._read_index()
+        if index is not None and index["model_fingerprint"] == model_fingerprint:
+            self.rows = index["rows"]
+            self.assets = index["assets"]
+            self.free = index["free"]
+            if os.path.exists(self._matrix_path):
+                self._matrix = np.load(self._matrix_path, mmap_mode="r+")
+
+    @property
+    def _matrix_path(self) -> str:
+        return os.path.join(self.root, "embeddings.npy")
+
+    @property
+    def _index_path(self) -> str:
+        return os.path.join(self.root, "index.json")
+
+    def _read_index(self) -> Optional[dict]:
+        if not os.path.exists(self._index_path):
+            return None
+        with open(self._index_path) as f:
+            return json.load(f)
+
+    def __len__(self) -> int:
+        return len(self.assets)
+
+    def sync(self, assets: Iterable) -> list:
+        """
+        Makes the store reflect `assets`, the current assets of the DatasetVersion.
+
+        Returns:
+            list: The assets whose Data has no stored embedding yet.
+        """
+        assets = list(assets)
+        self.assets = {str(asset.id): str(asset.data_id) for asset in assets}
+        referenced = set(self.assets.values())
+        for data_id in [data_id for data_id in self.rows if data_id not in referenced]:
+            self.free.append(self.rows.pop(data_id))
+
+        missing, queued = [], set()
+        for asset in assets:
+            data_id = str(asset.data_id)
+            if data_id not in self.rows and data_id not in queued:
+                missing.append(asset)
+                queued.add(data_id)
+        return missing
+
+    def _allocate(self, count: int, dim: int) -> List[int]:
+        slots = [self.free.pop() for _ in range(min(count, len(self.free)))]
+        used = len(self.rows) + len(self.free) + len(slots)
+        needed = used + count - len(slots)
+        capacity = 0 if self._matrix is None else self._matrix.shape[0]
+        if needed > capacity:
+            self._grow(max(needed, 2 * capacity, 64), dim)
+        slots.extend(range(used, used + count - len(slots)))
+        return slots
+
+    def _grow(self, capacity: int, dim: int):
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        os.close(fd)
+        try:
+            matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float16, shape=(capacity, dim))
+            if self._matrix is not None:
+                matrix[:self._matrix.shape[0]] = self._matrix
+            matrix.flush()
+            del matrix
+            os.replace(tmp_path, self._matrix_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self._matrix = np.load(self._matrix_path, mmap_mode="r+")
+
+    def add(self, assets: List, embeddings: np.ndarray):
+        """Stores one embedding (row of `embeddings`) per asset."""
+        if not assets:
+            return
+        embeddings = np.asarray(embeddings)
+        if self._matrix is not None and embeddings.shape[1] != self._matrix.shape[1]:
+            raise ValueError(f"Expected embeddings of size {self._matrix.shape[1]}, got {embeddings.shape[1]}.")
+        slots = self._allocate(len(assets), embeddings.shape[1])
+        self._matrix[slots] = embeddings.astype(np.float16)
+        for asset, slot in zip(assets, slots):
+            self.rows[str(asset.data_id)] = slot
+            self.assets[str(asset.id)] = str(asset.data_id)
+
+    def get(self, assets: Iterable) -> tuple:
+        """
+        Returns the `(assets, embeddings)` of the given assets that have a stored embedding,
+        embeddings being a float32 matrix with one row per returned asset.
+        """
+        stored = [asset for asset in assets if str(asset.data_id) in self.rows]
+        if not stored:
+            return [], np.zeros((0, 0 if self._matrix is None else self._matrix.shape[1]), dtype=np.float32)
+        slots = [self.rows[str(asset.data_id)] for asset in stored]
+        return stored, self._matrix[slots].astype(np.float32)
+
+    def save(self):
+        if self._matrix is not None:
+            self._matrix.flush()
+        index = {"model_fingerprint": self.model_fingerprint, "rows": self.rows, "assets": self.assets, "free": self.free}
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self._index_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
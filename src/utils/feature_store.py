@@ -0,0 +1,79 @@
+import io
+import os
+import re
+import tempfile
+from typing import Dict, Optional
+
+import numpy as np
+
+from utils.disk_cache import DiskCache
+
+
+class ImageFeatureStore:
+    """
+    On-disk store of per-image model outputs, read back as memory-mapped arrays.
+
+    Entries are keyed by the sha256 of the image content, under a namespace identifying the
+    model, so that identical images are only embedded once. A secondary index maps Picsellia
+    Data ids to content hashes so that cached entries can be found without downloading the image.
+
+    Files are kept in a `DiskCache` of `max_bytes`, reads refreshing them, so that the least recently
+    used entries are evicted once the store is full. An entry missing any of its fields is a miss.
+
+    Layout:
+        <root>/<namespace>/<hash[:2]>/<hash>.<field>.npy
+        <root>/<namespace>/index/<data_id>
+    """
+
+    def __init__(self, root: str, namespace: str, max_bytes: int = 20 * 1024 ** 3):
+        self.root = os.path.join(root, re.sub(r"[^A-Za-z0-9_.-]", "_", namespace))
+        os.makedirs(os.path.join(self.root, "index"), exist_ok=True)
+        # Index files are counted (and evicted) with the arrays, they are only a few bytes and refreshed by `lookup`
+        self.cache = DiskCache(self.root, max_bytes)
+
+    @staticmethod
+    def _cache_key(key: str, field: str) -> str:
+        return f"{key}.{field}.npy"
+
+    def _write_atomic(self, path: str, write):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def get(self, key: str, fields) -> Optional[Dict[str, np.ndarray]]:
+        """Returns the memory-mapped `fields` of `key`, or None if any of them is missing."""
+        paths = {field: self.cache.get_path(self._cache_key(key, field)) for field in fields}
+        if any(path is None for path in paths.values()):
+            return None
+        try:
+            return {field: np.load(path, mmap_mode="r") for field, path in paths.items()}
+        except FileNotFoundError:
+            # Evicted by another process in the meantime
+            return None
+
+    def put(self, key: str, arrays: Dict[str, np.ndarray]):
+        for field, array in arrays.items():
+            buffer = io.BytesIO()
+            np.save(buffer, array)
+            self.cache.put(self._cache_key(key, field), buffer.getvalue())
+
+    def lookup(self, data_id: str) -> Optional[str]:
+        """Returns the content hash recorded for a Picsellia Data id, if any."""
+        path = os.path.join(self.root, "index", str(data_id))
+        try:
+            with open(path) as f:
+                key = f.read().strip()
+            # Refreshed like the arrays, otherwise the index of the most used images would be evicted first
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return key
+
+    def link(self, data_id: str, key: str):
+        self._write_atomic(os.path.join(self.root, "index", str(data_id)), lambda f: f.write(key.encode()))
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import threading
+from typing import Optional
+
+from utils.disk_cache import DiskCache
+from utils.images import content_hash, fetch_image_bytes
+
+DEFAULT_IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.expanduser("~/.cache/cv-interns/images"))
+DEFAULT_IMAGE_CACHE_MAX_MB = int(os.getenv("IMAGE_CACHE_MAX_MB", "10240"))
+
+
+class ImageCache:
+    """
+    Local cache of the image files of Picsellia assets and Data, shared by the tools of every process.
+
+    Files are stored once per content, under their sha256, in a size-capped `DiskCache`. A
+    second small cache maps each Data id and object name, which changes when the file of a Data
+    is replaced, to the checksum of its content, so that cached files are found without any
+    request, not even for the (expiring) download url of the asset.
+
+    Layout:
+        <root>/blobs/<sha256[:2]>/<sha256>
+        <root>/index/<key[:2]>/<key>, key being the sha256 of "<data_id>:<object_name>"
+    """
+
+    def __init__(self, root: str = DEFAULT_IMAGE_CACHE_DIR, max_bytes: int = DEFAULT_IMAGE_CACHE_MAX_MB * 1024 ** 2):
+        self.root = root
+        self.blobs = DiskCache(os.path.join(root, "blobs"), max_bytes)
+        # Entries are 64 bytes, the index is only trimmed with a large number of Data
+        self.index = DiskCache(os.path.join(root, "index"), max(max_bytes // 1000, 1024 ** 2))
+
+    @staticmethod
+    def _index_key(asset) -> str:
+        # Assets point to their Data, Data objects of the Datalake are keyed by their own id
+        data_id = getattr(asset, "data_id", asset.id)
+        return hashlib.sha256(f"{data_id}:{asset.object_name}".encode()).hexdigest()
+
+    def checksum(self, asset) -> Optional[str]:
+        """Returns the sha256 of the cached file of `asset`, or None if it is not cached."""
+        checksum = self.index.get(self._index_key(asset))
+        return checksum.decode() if checksum is not None else None
+
+    def get(self, asset) -> Optional[bytes]:
+        checksum = self.checksum(asset)
+        # The file may have been evicted while its index entry was kept
+        return self.blobs.get(checksum) if checksum is not None else None
+
+    def contains(self, asset) -> bool:
+        """Whether the file of `asset` is cached, refreshing it so that it is not the next one evicted."""
+        checksum = self.checksum(asset)
+        return checksum is not None and self.blobs.get_path(checksum) is not None
+
+    def put(self, asset, data: bytes) -> str:
+        checksum = content_hash(data)
+        self.blobs.put(checksum, data)
+        self.index.put(self._index_key(asset), checksum.encode())
+        return checksum
+
+    def fetch(self, asset) -> bytes:
+        """Returns the file of `asset` from the cache, downloading and caching it on a miss."""
+        data = self.get(asset)
+        if data is None:
+            if asset.url is None:
+                # References sent without url were cached when sent, but have been evicted since
+                raise LookupError(f"Image of {asset.id} is not cached anymore and has no url")
+            data = fetch_image_bytes(asset.url)
+            self.put(asset, data)
+        return data
+
+
+_image_cache: Optional[ImageCache] = None
+_image_cache_lock = threading.Lock()
+
+
+def get_image_cache() -> Optional[ImageCache]:
+    """Returns the shared image cache, created on first use rather than when the tools are imported, or None if disabled."""
+    global _image_cache
+    if DEFAULT_IMAGE_CACHE_MAX_MB <= 0:
+        return None
+    with _image_cache_lock:
+        if _image_cache is None:
+            _image_cache = ImageCache()
+        return _image_cache
+
+
+def is_asset_cached(asset) -> bool:
+    """Whether the image of `asset` can be read without any request, not even for its url."""
+    image_cache = get_image_cache()
+    return image_cache is not None and image_cache.contains(asset)
+
+
+def fetch_asset_bytes(asset) -> bytes:
+    """Returns the image file of a Picsellia asset or Data, through the shared image cache when enabled."""
+    image_cache = get_image_cache()
+    if image_cache is None:
+        return fetch_image_bytes(asset.url)
+    return image_cache.fetch(asset)
@@ -0,0 +1,55 @@
+import hashlib
+import io
+import math
+from typing import Optional
+
+from PIL import Image
+
+from utils.downloads import download_client
+
+
+def fetch_image_bytes(url: str) -> bytes:
+    # Pooled connections, timeouts and retries of the shared client
+    return download_client.get_bytes(url)
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def decode_image(data: bytes, target_size: Optional[int] = None, fit: str = "longest") -> Image.Image:
+    """
+    Decodes `data` to an RGB image, optionally at a reduced resolution.
+
+    When `target_size` is given, the image is decoded at the smallest resolution whose longest
+    (`fit="longest"`) or shortest (`fit="shortest"`) side is still at least `target_size`, which
+    is all a model resizing to `target_size` needs. JPEG images are decoded directly at that scale
+    with the DCT draft mode, other formats are decoded then reduced by an integer factor.
+
+    The original (width, height) is kept in `image.info["original_size"]`, so that coordinates can
+    be scaled back, and the sha256 of `data` in `image.info["content_hash"]` so that caches can key
+    on the image content.
+    """
+    image = Image.open(io.BytesIO(data))
+    # Only the header is read so far, the size is known before decoding
+    original_size = image.size
+
+    if target_size is not None:
+        side = max(original_size) if fit == "longest" else min(original_size)
+        if side > target_size:
+            scale = target_size / side
+            requested_size = tuple(math.ceil(dimension * scale) for dimension in original_size)
+            if image.format == "JPEG":
+                image.draft("RGB", requested_size)
+            else:
+                factor = side // target_size
+                if factor >= 2:
+                    # A partial last box would be averaged over fewer pixels and shift the geometry,
+                    # the few remainder rows and columns are left out instead, as in draft mode
+                    width, height = original_size
+                    image = image.reduce(factor, box=(0, 0, width - width % factor, height - height % factor))
+
+    image = image.convert("RGB")
+    image.info["original_size"] = original_size
+    image.info["content_hash"] = content_hash(data)
+    return image
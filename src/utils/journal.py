@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Set
+
+DEFAULT_JOURNAL_PATH = os.getenv(
+    "PREANNOTATION_JOURNAL_PATH", os.path.expanduser("~/.cache/cv-interns/preannotation.sqlite")
+)
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+def config_fingerprint(config: dict) -> str:
+    """Returns a short stable hash of a JSON-serializable configuration."""
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class PreAnnotationJournal:
+    """
+    SQLite journal recording the status of every asset of a pre-annotation job.
+
+    A job is identified by the fingerprint of its configuration (model, prompts, thresholds...),
+    so that restarting the same job skips the assets it already completed, while changing the
+    configuration starts a new job.
+    """
+
+    def __init__(self, config: dict, path: str = DEFAULT_JOURNAL_PATH):
+        self.config = config
+        self.job_id = config_fingerprint(config)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, config TEXT, created_at REAL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS assets ("
+                "job_id TEXT, asset_id TEXT, status TEXT, error TEXT, updated_at REAL, "
+                "PRIMARY KEY (job_id, asset_id))"
+            )
+            self._connection.execute(
+                "INSERT OR IGNORE INTO jobs VALUES (?, ?, ?)",
+                (self.job_id, json.dumps(config, sort_keys=True), time.time()),
+            )
+
+    def _write(self, statuses: Dict[str, tuple]):
+        now = time.time()
+        rows = [(self.job_id, str(asset_id), status, error, now) for asset_id, (status, error) in statuses.items()]
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?, ?)", rows)
+
+    def mark_pending(self, asset_ids: Iterable[str]):
+        self._write({asset_id: (PENDING, None) for asset_id in asset_ids})
+
+    def mark_done(self, asset_ids: Iterable[str]):
+        self._write({asset_id: (DONE, None) for asset_id in asset_ids})
+
+    def mark_failed(self, errors: Dict[str, str]):
+        self._write({asset_id: (FAILED, error) for asset_id, error in errors.items()})
+
+    def completed(self) -> Set[str]:
+        """Returns the ids of the assets this job already annotated."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT asset_id FROM assets WHERE job_id = ? AND status = ?", (self.job_id, DONE)
+            ).fetchall()
+        return {asset_id for asset_id, in rows}
+
+    def summary(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT status, COUNT(*) FROM assets WHERE job_id = ? GROUP BY status", (self.job_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def close(self):
+        self._connection.close()
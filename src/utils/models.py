@@ -0,0 +1,130 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_BUDGET_MB = int(os.getenv("MODEL_REGISTRY_MEMORY_BUDGET_MB", "4096"))
+
+
+def select_device(preferred: Optional[str] = None) -> str:
+    """
+    Returns the device models should run on.
+
+    The `preferred` device is used when it is available on this machine, otherwise the best
+    available device is picked in the order cuda > mps > cpu.
+    """
+    mps_available = hasattr(torch.backends, "mps") and torch.backends.mps.is_available()
+    if preferred is not None:
+        if preferred == "cpu":
+            return preferred
+        if preferred.startswith("cuda") and torch.cuda.is_available():
+            return preferred
+        if preferred == "mps" and mps_available:
+            return preferred
+        logger.warning(f"Device {preferred} is not available, falling back to automatic selection.")
+
+    if torch.cuda.is_available():
+        return "cuda"
+    if mps_available:
+        return "mps"
+    return "cpu"
+
+
+def select_dtype(name: str, device: str) -> Optional[torch.dtype]:
+    """
+    Returns the weights dtype named `name` ("float32", "float16" or "bfloat16") for `device`.
+
+    "auto" picks float16 on accelerators and keeps the checkpoint default (None) on CPU,
+    where half-precision matmuls are only faster on recent CPUs with bfloat16 support.
+    """
+    if name == "auto":
+        return torch.float16 if device.startswith("cuda") or device == "mps" else None
+    dtypes = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+    if name not in dtypes:
+        raise ValueError(f"Unknown dtype {name}, expected auto or one of {tuple(dtypes)}.")
+    return dtypes[name]
+
+
+def model_memory_footprint(model: torch.nn.Module) -> int:
+    """Returns the number of bytes held by the parameters and buffers of `model`."""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of Hugging Face models and their processors.
+
+    Each (model class, model id, device, dtype) is loaded once and shared by every tool.
+    When the total size of the loaded weights exceeds `memory_budget_mb`, the least
+    recently used models are evicted.
+    """
+
+    def __init__(self, memory_budget_mb: int = DEFAULT_MEMORY_BUDGET_MB):
+        self.memory_budget = memory_budget_mb * 1024 ** 2
+        self._entries: "OrderedDict[Tuple[str, str, str, str], Tuple[Any, Any, int]]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, model_cls, processor_cls, model_id: str, device: Optional[str] = None, dtype: Optional[torch.dtype] = None) -> Tuple[Any, Any]:
+        """
+        Returns the `(model, processor)` pair for `model_id`, loading it on first use.
+
+        Args:
+            model_cls: Hugging Face model class exposing `from_pretrained`.
+            processor_cls: Hugging Face processor class exposing `from_pretrained`, or None.
+            model_id (str): Hub identifier or local path of the model.
+            device (str, optional): Preferred device, automatically selected when None or unavailable.
+            dtype (torch.dtype, optional): Weights dtype, the checkpoint default when None.
+
+        Returns:
+            Tuple: The model in eval mode on its device, and its processor.
+        """
+        device = select_device(device)
+        key = (model_cls.__name__, model_id, device, str(dtype))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                model, processor, _ = self._entries[key]
+                return model, processor
+
+            logger.info(f"Loading {model_id} on {device}")
+            processor = processor_cls.from_pretrained(model_id) if processor_cls is not None else None
+            if dtype is not None:
+                model = model_cls.from_pretrained(model_id, torch_dtype=dtype)
+            else:
+                model = model_cls.from_pretrained(model_id)
+            model.to(device)
+            model.eval()
+
+            self._entries[key] = (model, processor, model_memory_footprint(model))
+            self._evict()
+            return model, processor
+
+    @property
+    def memory_usage(self) -> int:
+        return sum(footprint for _, _, footprint in self._entries.values())
+
+    def _evict(self):
+        # The most recently used model is always kept, even if it alone exceeds the budget.
+        evicted = False
+        while self.memory_usage > self.memory_budget and len(self._entries) > 1:
+            key, _ = self._entries.popitem(last=False)
+            logger.info(f"Evicting {key[1]} from {key[2]} (memory budget exceeded)")
+            evicted = True
+        if evicted and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+model_registry = ModelRegistry()
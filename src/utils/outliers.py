@@ -0,0 +1,129 @@
+from typing import Union
+
+import numpy as np
+
+OUTLIER_METHODS = ("centroid", "knn", "lof")
+
+
+def _normalize(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def nearest_neighbours(embeddings: np.ndarray, k: int = 10, query_block: int = 1024,
+                       reference_block: int = 4096) -> tuple:
+    """
+    Exact k nearest neighbours of each embedding among the others, by cosine distance.
+
+    Similarities are computed by blocks of `query_block` x `reference_block` (16MB in float32 by
+    default), so that the n x n similarity matrix is never materialized. The k best candidates of
+    each block are selected with `argpartition` and merged with those of the previous blocks.
+
+    Returns:
+        tuple: `(distances, indices)`, two n x k arrays sorted by increasing cosine distance, where
+        k is at most n - 1.
+    """
+    embeddings = _normalize(embeddings)
+    count = len(embeddings)
+    k = min(k, count - 1)
+    if k <= 0:
+        return np.zeros((count, 0), dtype=np.float32), np.zeros((count, 0), dtype=np.int64)
+
+    distances = np.empty((count, k), dtype=np.float32)
+    indices = np.empty((count, k), dtype=np.int64)
+    for query_start in range(0, count, query_block):
+        queries = embeddings[query_start:query_start + query_block]
+        rows = np.arange(len(queries))
+        best_similarities = np.empty((len(queries), 0), dtype=np.float32)
+        best_indices = np.empty((len(queries), 0), dtype=np.int64)
+
+        for reference_start in range(0, count, reference_block):
+            similarities = queries @ embeddings[reference_start:reference_start + reference_block].T
+            # Excludes each embedding from its own neighbours
+            own = rows + query_start - reference_start
+            inside = (own >= 0) & (own < similarities.shape[1])
+            similarities[rows[inside], own[inside]] = -np.inf
+
+            candidates = np.arange(similarities.shape[1])[None, :].repeat(len(queries), axis=0)
+            if similarities.shape[1] > k:
+                candidates = np.argpartition(similarities, -k, axis=1)[:, -k:]
+            best_similarities = np.concatenate(
+                [best_similarities, np.take_along_axis(similarities, candidates, axis=1)], axis=1
+            )
+            best_indices = np.concatenate([best_indices, candidates + reference_start], axis=1)
+            if best_similarities.shape[1] > k:
+                kept = np.argpartition(best_similarities, -k, axis=1)[:, -k:]
+                best_similarities = np.take_along_axis(best_similarities, kept, axis=1)
+                best_indices = np.take_along_axis(best_indices, kept, axis=1)
+
+        order = np.argsort(-best_similarities, axis=1)
+        block = slice(query_start, query_start + len(queries))
+        distances[block] = np.clip(1 - np.take_along_axis(best_similarities, order, axis=1), 0, 2)
+        indices[block] = np.take_along_axis(best_indices, order, axis=1)
+    return distances, indices
+
+
+def centroid_scores(embeddings: np.ndarray) -> np.ndarray:
+    """Euclidean distance of each embedding to the mean embedding."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    return np.linalg.norm(embeddings - embeddings.mean(axis=0), axis=1)
+
+
+def knn_scores(distances: np.ndarray) -> np.ndarray:
+    """Distance of each embedding to its k-th nearest neighbour, from `nearest_neighbours`."""
+    if not distances.shape[1]:
+        return np.zeros(len(distances), dtype=np.float32)
+    return distances[:, -1]
+
+
+def lof_scores(distances: np.ndarray, indices: np.ndarray) -> np.ndarray:
+    """
+    Local outlier factor of each embedding, from `nearest_neighbours`: the mean local density of
+    its neighbours over its own, about 1 inside a cluster and well above 1 for outliers, even
+    next to a denser cluster.
+    """
+    if not distances.shape[1]:
+        return np.ones(len(distances), dtype=np.float32)
+    k_distances = distances[:, -1]
+    reachability = np.maximum(distances, k_distances[indices])
+    # Duplicates have a null reachability, their density is capped instead of infinite
+    densities = 1 / np.maximum(reachability.mean(axis=1), 1e-6)
+    return densities[indices].mean(axis=1) / densities
+
+
+def outlier_scores(embeddings: np.ndarray, method: str = "lof", k: int = 10) -> np.ndarray:
+    """Scores each embedding with `method`, one of `OUTLIER_METHODS`, the highest scores being the most unusual."""
+    if method not in OUTLIER_METHODS:
+        raise ValueError(f"Unknown outlier method {method}, expected one of {OUTLIER_METHODS}.")
+    if method == "centroid":
+        return centroid_scores(embeddings)
+    distances, indices = nearest_neighbours(embeddings, k)
+    return knn_scores(distances) if method == "knn" else lof_scores(distances, indices)
+
+
+def parse_contamination(contamination: Union[float, str]) -> Union[float, str]:
+    """Returns `contamination` as a fraction in ]0, 0.5], or `auto`."""
+    if contamination == "auto":
+        return contamination
+    fraction = float(contamination)
+    if not 0 < fraction <= 0.5:
+        raise ValueError(f"Expected a contamination in ]0, 0.5] or `auto`, got {contamination}.")
+    return fraction
+
+
+def outlier_threshold(scores: np.ndarray, contamination: Union[float, str] = "auto") -> float:
+    """
+    Returns the score above which embeddings are outliers.
+
+    Args:
+        scores (np.ndarray): Outlier scores.
+        contamination (Union[float, str]): Expected fraction of outliers, in ]0, 0.5], or `auto` for
+            Tukey's upper fence (third quartile plus 1.5 interquartile ranges), which flags only
+            the scores far off the bulk of the distribution, possibly none.
+    """
+    contamination = parse_contamination(contamination)
+    if contamination == "auto":
+        first_quartile, third_quartile = np.percentile(scores, [25, 75])
+        return float(third_quartile + 1.5 * (third_quartile - first_quartile))
+    return float(np.quantile(scores, 1 - contamination))
@@ -0,0 +1,134 @@
+from typing import List, Sequence
+
+import numpy as np
+from PIL import Image
+
+from utils.images import decode_image
+
+HASH_METHODS = ("phash", "dhash")
+# Side of the grayscale thumbnail the DCT of pHash is computed on
+PHASH_SIZE = 32
+# Shortest side images are decoded at before being resized to the thumbnails. JPEG draft mode and the
+# integer reduction of the other formats only agree well above the thumbnail size, decoding straight
+# to it made the JPEG and PNG copies of an image hash several bits apart.
+HASH_DECODE_SIZE = 8 * PHASH_SIZE
+
+# Number of set bits of every byte value, for vectorized Hamming distances
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    """Orthonormal DCT-II matrix, `matrix @ x` being the DCT of the vector x."""
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.sqrt(2 / size) * np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT = _dct_matrix(PHASH_SIZE)
+
+
+def _pack(bits: np.ndarray) -> np.uint64:
+    return np.packbits(bits.ravel().astype(np.uint8)).view(">u8")[0].astype(np.uint64)
+
+
+def dhash(image: Image.Image) -> np.uint64:
+    """64-bit difference hash: whether each pixel of a 9x8 thumbnail is brighter than its right neighbour."""
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    return _pack(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(image: Image.Image) -> np.uint64:
+    """64-bit perceptual hash: signs of the 8x8 lowest frequencies of the DCT of a 32x32 thumbnail, against their median."""
+    pixels = np.asarray(image.convert("L").resize((PHASH_SIZE, PHASH_SIZE), Image.BILINEAR), dtype=np.float32)
+    frequencies = (_DCT @ pixels @ _DCT.T)[:8, :8]
+    return _pack(frequencies > np.median(frequencies.ravel()[1:]))
+
+
+def hash_image_bytes(data: bytes, method: str = "phash") -> np.uint64:
+    """Hashes an encoded image, decoded at a reduced resolution when the format allows it."""
+    image = decode_image(data, target_size=HASH_DECODE_SIZE, fit="shortest")
+    return phash(image) if method == "phash" else dhash(image)
+
+
+def hash_many(datas: List[bytes], method: str = "phash") -> List[tuple]:
+    """
+    Hashes several encoded images, e.g. in a worker process to amortize the inter-process transfer.
+
+    Returns:
+        List[tuple]: `(hash, error)` per image, `hash` being None when the image could not be hashed.
+    """
+    results = []
+    for data in datas:
+        try:
+            results.append((hash_image_bytes(data, method), None))
+        except Exception as e:
+            results.append((None, str(e)))
+    return results
+
+
+def hamming_distances(left, right) -> np.ndarray:
+    """Returns the Hamming distances between the hashes of `left` and `right`, broadcast against each other."""
+    xor = np.bitwise_xor(np.asarray(left, dtype=np.uint64), np.asarray(right, dtype=np.uint64))
+    return _POPCOUNT[xor[..., None].view(np.uint8)].sum(axis=-1)
+
+
+def _bands(max_distance: int) -> List[tuple]:
+    """Splits the 64 bits into `max_distance + 1` bands of contiguous bits, as (shift, mask)."""
+    count = max_distance + 1
+    bounds = np.linspace(0, 64, count + 1).astype(int)
+    return [(int(start), (1 << int(end - start)) - 1) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def group_near_duplicates(hashes: Sequence[int], max_distance: int = 4) -> List[List[int]]:
+    """
+    Groups the indices of `hashes` whose Hamming distance is at most `max_distance`, transitively.
+
+    Uses multi-index hashing: the 64 bits are split into `max_distance + 1` bands, so that two
+    hashes within `max_distance` bits of each other are identical on at least one band. Hashes
+    are sorted by band value, and only the hashes sharing a value are compared, with vectorized
+    popcounts over the whole array for each offset within the buckets.
+
+    Returns:
+        List[List[int]]: Groups of at least two indices, each sorted, largest groups first.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    # Identical hashes are grouped directly, the bands only compare distinct values
+    unique, inverse = np.unique(hashes, return_inverse=True)
+
+    pairs = []
+    if max_distance > 0:
+        for shift, mask in _bands(max_distance):
+            keys = (unique >> np.uint64(shift)) & np.uint64(mask)
+            order = np.argsort(keys, kind="stable")
+            sorted_keys = keys[order]
+            offset = 1
+            # Compares each hash with the one `offset` positions later, as long as some still share a bucket
+            while offset < len(order):
+                same_bucket = np.nonzero(sorted_keys[offset:] == sorted_keys[:-offset])[0]
+                if not len(same_bucket):
+                    break
+                left, right = order[same_bucket], order[same_bucket + offset]
+                close = hamming_distances(unique[left], unique[right]) <= max_distance
+                pairs.append(np.stack([left[close], right[close]], axis=1))
+                offset += 1
+
+    parent = np.arange(len(unique))
+
+    def find(node: int) -> int:
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for left, right in (np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)):
+        root, other_root = find(left), find(right)
+        if root != other_root:
+            parent[other_root] = root
+
+    roots = np.array([find(node) for node in range(len(unique))], dtype=np.int64)[inverse]
+    groups = {}
+    for index, root in enumerate(roots):
+        groups.setdefault(int(root), []).append(index)
+    return sorted((group for group in groups.values() if len(group) > 1), key=len, reverse=True)
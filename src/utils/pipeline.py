@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+
+class PipelineStats:
+    """
+    Thread-safe timing counters of a prefetching pipeline.
+
+    `io_seconds` is the cumulated time spent by the workers loading items, `stall_seconds` the time
+    the consumer waited for an item that was not ready yet, and `compute_seconds` the time the consumer
+    reports through `timer("compute")`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seconds = {"io": 0.0, "stall": 0.0, "compute": 0.0}
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def timer(self, stage: str) -> "_StageTimer":
+        return _StageTimer(self, stage)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {f"{stage}_seconds": round(seconds, 2) for stage, seconds in self.seconds.items()}
+
+
+class _StageTimer:
+    def __init__(self, stats: PipelineStats, stage: str):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def prefetch(items: Iterable[Any], load: Callable[[Any], Any], max_workers: int = 4, depth: int = 8,
+             stats: Optional[PipelineStats] = None) -> Iterator[Tuple[Any, Any, Optional[Exception]]]:
+    """
+    Loads `items` in a bounded thread pool while the caller consumes the previous ones.
+
+    At most `depth` items are in flight or loaded-but-not-consumed at any time, so memory stays
+    bounded whatever the number of items. Results are yielded in input order.
+
+    Args:
+        items (Iterable): Items to load, consumed lazily.
+        load (Callable): Function loading one item, e.g. downloading and decoding an image.
+        max_workers (int): Number of loading threads.
+        depth (int): Maximum number of items loaded ahead of the consumer.
+        stats (PipelineStats, optional): Counters updated with the io and stall times.
+
+    Yields:
+        Tuple: `(item, loaded, error)` where `error` is the exception raised by `load`, if any.
+    """
+    stats = stats if stats is not None else PipelineStats()
+    depth = max(depth, 1)
+
+    def timed_load(item):
+        with stats.timer("io"):
+            return load(item)
+
+    iterator = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        def submit() -> bool:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return False
+            pending.append((item, pool.submit(timed_load, item)))
+            return True
+
+        while len(pending) < depth and submit():
+            pass
+
+        try:
+            while pending:
+                item, future = pending.popleft()
+                with stats.timer("stall"):
+                    try:
+                        loaded, error = future.result(), None
+                    except Exception as e:
+                        loaded, error = None, e
+                submit()
+                yield item, loaded, error
+        finally:
+            # The consumer may stop early, do not load what will never be consumed
+            for _, future in pending:
+                future.cancel()
+
+
+def batched(iterable: Iterable[Any], batch_size: int) -> Iterator[List[Any]]:
+    """Groups `iterable` into lists of at most `batch_size` elements."""
+    batch = []
+    for element in iterable:
+        batch.append(element)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,188 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from utils.journal import config_fingerprint
+
+
+class PixelCache:
+    """
+    On-disk cache of model-ready pixel tensors, read back as memory-mapped arrays.
+
+    Every image preprocessed with the same `config` (model, resolution, normalization...) has the
+    same `shape`, so entries are rows of fixed-size shard files of `shard_size` images, and reading
+    an entry neither decodes nor allocates anything. Entries are keyed by the sha256 of the image
+    content, and an SQLite index maps keys to rows and Picsellia Data ids to keys, so that cached
+    images are found without downloading them. Rows are allocated under the SQLite write lock,
+    which makes the cache safe to share between processes.
+
+    The cache holds at most `max_bytes` of pixels, rounded up to a whole shard. Once full, a new entry takes over the row of the
+    least recently read or written entry, so the shard files stop growing. Arrays returned by `get`
+    are views of the rows: they must be used (e.g. copied into a batch) before that many other
+    entries are written, which is always the case with a budget of more than a few batches.
+
+    Layout:
+        <root>/<fingerprint of config>/config.json
+        <root>/<fingerprint of config>/index.sqlite
+        <root>/<fingerprint of config>/shard-<n>.npy
+    """
+
+    def __init__(self, root: str, config: dict, shape: Sequence[int], dtype=np.float16, shard_size: int = 256,
+                 max_bytes: Optional[int] = None):
+        self.root = os.path.join(root, config_fingerprint(config))
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.shard_size = shard_size
+        row_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        # Unbounded without a budget
+        self.max_entries = max(max_bytes // row_bytes, 1) if max_bytes is not None else None
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, "config.json"), "w") as f:
+            json.dump({**config, "shape": self.shape, "dtype": self.dtype.name}, f, sort_keys=True)
+
+        self._lock = threading.Lock()
+        self._shards: Dict[int, np.memmap] = {}
+        self._connection = sqlite3.connect(os.path.join(self.root, "index.sqlite"), timeout=30,
+                                           check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(key TEXT PRIMARY KEY, slot INTEGER UNIQUE, meta TEXT, ready INTEGER, last_used REAL DEFAULT 0)"
+        )
+        columns = [column[1] for column in self._connection.execute("PRAGMA table_info(entries)")]
+        if "last_used" not in columns:
+            # Caches created before the budget existed
+            self._connection.execute("ALTER TABLE entries ADD COLUMN last_used REAL DEFAULT 0")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS links (data_id TEXT PRIMARY KEY, key TEXT)")
+        if self.max_entries is not None:
+            self._trim()
+
+    def _free_slot(self) -> int:
+        """Returns the lowest slot without entry, rows of trimmed entries being reused first."""
+        slot, = self._connection.execute(
+            "SELECT CASE WHEN NOT EXISTS (SELECT 1 FROM entries WHERE slot = 0) THEN 0 "
+            "ELSE (SELECT MIN(slot) + 1 FROM entries AS e WHERE NOT EXISTS "
+            "(SELECT 1 FROM entries WHERE slot = e.slot + 1)) END"
+        ).fetchone()
+        return slot
+
+    def _trim(self):
+        """Drops the entries and shards beyond the budget, e.g. after it was lowered."""
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.execute(
+                    "DELETE FROM links WHERE key IN (SELECT key FROM entries WHERE slot >= ?)", (self.max_entries,)
+                )
+                self._connection.execute("DELETE FROM entries WHERE slot >= ?", (self.max_entries,))
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+        shard = -(-self.max_entries // self.shard_size)
+        while os.path.exists(self._shard_path(shard)):
+            os.remove(self._shard_path(shard))
+            shard += 1
+
+    def _shard_path(self, shard: int) -> str:
+        return os.path.join(self.root, f"shard-{shard:05d}.npy")
+
+    def _create_shard(self, shard: int):
+        path = self._shard_path(shard)
+        if os.path.exists(path):
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        os.close(fd)
+        try:
+            np.lib.format.open_memmap(tmp_path, mode="w+", dtype=self.dtype, shape=(self.shard_size, *self.shape)).flush()
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _row(self, slot: int) -> np.memmap:
+        shard, row = divmod(slot, self.shard_size)
+        if shard not in self._shards:
+            self._shards[shard] = np.load(self._shard_path(shard), mmap_mode="r+")
+        return self._shards[shard][row]
+
+    def get(self, key: str) -> Optional[Tuple[np.ndarray, dict]]:
+        """Returns the memory-mapped pixels of `key` and the metadata stored with them, or None."""
+        with self._lock:
+            entry = self._connection.execute(
+                "SELECT slot, meta FROM entries WHERE key = ? AND ready = 1", (key,)
+            ).fetchone()
+            if entry is None:
+                return None
+            slot, meta = entry
+            self._connection.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            return self._row(slot), json.loads(meta)
+
+    def put(self, key: str, pixels: np.ndarray, meta: Optional[dict] = None):
+        if pixels.shape != self.shape:
+            raise ValueError(f"Expected pixels of shape {self.shape}, got {pixels.shape}.")
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                entry = self._connection.execute("SELECT slot, ready FROM entries WHERE key = ?", (key,)).fetchone()
+                if entry is not None and entry[1]:
+                    self._connection.execute("COMMIT")
+                    return
+                if entry is not None:
+                    # Left unwritten by an interrupted put, or being written by another process: the content
+                    # is the same, the reserved row is written again
+                    slot = entry[0]
+                    self._connection.execute(
+                        "UPDATE entries SET meta = ?, last_used = ? WHERE key = ?",
+                        (json.dumps(meta or {}), time.time(), key),
+                    )
+                else:
+                    count, = self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()
+                    if self.max_entries is not None and count >= self.max_entries:
+                        # Full, the least recently used entry gives its row up
+                        evicted, slot = self._connection.execute(
+                            "SELECT key, slot FROM entries ORDER BY last_used LIMIT 1"
+                        ).fetchone()
+                        self._connection.execute("DELETE FROM entries WHERE key = ?", (evicted,))
+                        self._connection.execute("DELETE FROM links WHERE key = ?", (evicted,))
+                    else:
+                        slot = self._free_slot()
+                        self._create_shard(slot // self.shard_size)
+                    self._connection.execute(
+                        "INSERT INTO entries VALUES (?, ?, ?, 0, ?)", (key, slot, json.dumps(meta or {}), time.time())
+                    )
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+            # The row is reserved, it is only visible to readers once written
+            try:
+                row = self._row(slot)
+                row[...] = pixels
+                row.flush()
+            except BaseException:
+                # Frees the row, the image can be cached again
+                self._connection.execute("DELETE FROM entries WHERE key = ? AND ready = 0", (key,))
+                raise
+            self._connection.execute("UPDATE entries SET ready = 1 WHERE key = ?", (key,))
+
+    def lookup(self, data_id: str) -> Optional[str]:
+        """Returns the content hash recorded for a Picsellia Data id, if any."""
+        with self._lock:
+            link = self._connection.execute("SELECT key FROM links WHERE data_id = ?", (str(data_id),)).fetchone()
+        return link[0] if link is not None else None
+
+    def link(self, data_id: str, key: str):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO links VALUES (?, ?)", (str(data_id), key))
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,63 @@
+from typing import List, Sequence
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+OPENAI_CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+OPENAI_CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+def _resize_uint8(image: torch.Tensor, size: tuple) -> torch.Tensor:
+    """Antialiased bilinear resize of a (1, 3, H, W) uint8 tensor, returned as float in [0, 255]."""
+    try:
+        # Native uint8 kernel of recent PyTorch versions, several times faster than float on CPU
+        resized = F.interpolate(image.contiguous(memory_format=torch.channels_last), size=size,
+                                mode="bilinear", antialias=True, align_corners=False)
+        return resized.float()
+    except RuntimeError:
+        return F.interpolate(image.float(), size=size, mode="bilinear", antialias=True, align_corners=False)
+
+
+def owlv2_preprocess(images: List[Image.Image], size: int = 960, mean: Sequence[float] = OPENAI_CLIP_MEAN,
+                     std: Sequence[float] = OPENAI_CLIP_STD, pad_value: float = 0.5) -> torch.Tensor:
+    """
+    Fast CPU equivalent of `Owlv2ImageProcessor` for a batch of RGB images.
+
+    Each image is resized so that its longest side is `size`, then padded at the bottom and right
+    with `pad_value` to a `size` x `size` square and normalized. Resizing before padding only touches the
+    pixels of the image, and the antialiased bilinear kernel replaces the gaussian filter plus
+    interpolation of the Hugging Face processor, so values differ slightly at edges.
+
+    The original OWLv2 pads with grey (0.5), as do transformers 4.x processors, while transformers
+    5.x pads with black (0.0).
+
+    Returns:
+        torch.Tensor: (batch, 3, size, size) float32 pixel values.
+    """
+    batch = torch.full((len(images), 3, size, size), float(pad_value))
+    for i, image in enumerate(images):
+        pixels = torch.from_numpy(np.array(image.convert("RGB"))).permute(2, 0, 1).unsqueeze(0)
+        height, width = pixels.shape[-2:]
+        scale = size / max(height, width)
+        new_height, new_width = max(1, round(height * scale)), max(1, round(width * scale))
+        batch[i, :, :new_height, :new_width] = _resize_uint8(pixels, (new_height, new_width))[0] / 255
+
+    batch.sub_(torch.tensor(mean).view(1, 3, 1, 1)).div_(torch.tensor(std).view(1, 3, 1, 1))
+    return batch
+
+
+def compare_with_processor(images: List[Image.Image], processor, pad_value: float = 0.5) -> dict:
+    """
+    Compares `owlv2_preprocess` with the Hugging Face `processor` on `images`.
+
+    Returns:
+        dict: `max_abs_diff` and `mean_abs_diff` of the normalized pixel values.
+    """
+    image_processor = processor.image_processor
+    reference = processor(images=images, return_tensors="pt")["pixel_values"]
+    fast = owlv2_preprocess(images, size=image_processor.size["height"],
+                            mean=image_processor.image_mean, std=image_processor.image_std, pad_value=pad_value)
+    diff = (fast - reference).abs()
+    return {"max_abs_diff": float(diff.max()), "mean_abs_diff": float(diff.mean())}
@@ -0,0 +1,176 @@
+from typing import Optional
+
+import numpy as np
+
+
+class RunningMoments:
+    """
+    Running mean and covariance of a stream of vectors, in memory independent of the number of vectors.
+
+    Batches are merged with the parallel form of Welford's algorithm (Chan et al.), which stays
+    numerically stable where accumulating sums and sums of squares would not.
+    """
+
+    def __init__(self, dim: int, covariance: bool = True):
+        self.dim = dim
+        self.count = 0
+        self.mean = np.zeros(dim, dtype=np.float64)
+        # Sum of the outer products of the deviations from the mean, `covariance` is derived from it
+        self._m2 = np.zeros((dim, dim), dtype=np.float64) if covariance else None
+
+    def update(self, vectors: np.ndarray):
+        vectors = np.asarray(vectors, dtype=np.float64).reshape(-1, self.dim)
+        if not len(vectors):
+            return
+        batch_count = len(vectors)
+        batch_mean = vectors.mean(axis=0)
+        total = self.count + batch_count
+        delta = batch_mean - self.mean
+        if self._m2 is not None:
+            deviations = vectors - batch_mean
+            self._m2 += deviations.T @ deviations + np.outer(delta, delta) * (self.count * batch_count / total)
+        self.mean += delta * (batch_count / total)
+        self.count = total
+
+    @property
+    def covariance(self) -> Optional[np.ndarray]:
+        """Sample covariance matrix, None when not tracked."""
+        if self._m2 is None:
+            return None
+        return self._m2 / max(self.count - 1, 1)
+
+
+class P2Quantile:
+    """
+    Streaming estimate of the `q` quantile of a stream of numbers, with the P² algorithm (Jain & Chlamtac).
+
+    Only five markers are kept, whose heights are adjusted with a piecewise-parabolic
+    interpolation as values arrive. The estimate is exact for the first five values.
+    """
+
+    def __init__(self, q: float):
+        if not 0 < q < 1:
+            raise ValueError(f"Expected a quantile in ]0, 1[, got {q}.")
+        self.q = q
+        self.count = 0
+        self._heights = []
+        self._positions = np.arange(1, 6, dtype=np.float64)
+        self._desired = np.array([1, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5], dtype=np.float64)
+        self._increments = np.array([0, q / 2, q, (1 + q) / 2, 1], dtype=np.float64)
+
+    def add(self, value: float):
+        value = float(value)
+        self.count += 1
+        if self.count <= 5:
+            self._heights.append(value)
+            self._heights.sort()
+            return
+
+        heights, positions = self._heights, self._positions
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = next(i for i in range(4) if heights[i] <= value < heights[i + 1])
+        positions[cell + 1:] += 1
+        self._desired += self._increments
+
+        for i in range(1, 4):
+            offset = self._desired[i] - positions[i]
+            if (offset >= 1 and positions[i + 1] - positions[i] > 1) or (offset <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1.0 if offset > 0 else -1.0
+                height = self._parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * (heights[i + int(step)] - heights[i]) / (positions[i + int(step)] - positions[i])
+                heights[i] = height
+                positions[i] += step
+
+    def _parabolic(self, i: int, step: float) -> float:
+        heights, positions = self._heights, self._positions
+        return heights[i] + step / (positions[i + 1] - positions[i - 1]) * (
+            (positions[i] - positions[i - 1] + step) * (heights[i + 1] - heights[i]) / (positions[i + 1] - positions[i])
+            + (positions[i + 1] - positions[i] - step) * (heights[i] - heights[i - 1]) / (positions[i] - positions[i - 1])
+        )
+
+    def extend(self, values):
+        for value in np.asarray(values, dtype=np.float64).ravel():
+            self.add(value)
+
+    @property
+    def value(self) -> Optional[float]:
+        """Current estimate of the quantile, None before the first value."""
+        if self.count == 0:
+            return None
+        if self.count <= 5:
+            return float(np.quantile(self._heights, self.q))
+        return float(self._heights[2])
+
+
+class StreamingOutlierScorer:
+    """
+    Scores embeddings as they are computed, against the statistics of the embeddings seen so far.
+
+    Each batch updates the running mean (and covariance for the `mahalanobis` metric) before being
+    scored, and the scores feed a P² sketch of their `quantile`, the outlier threshold. Scores are
+    provisional: early embeddings are scored against statistics of fewer samples, which include
+    themselves, and are under-flagged compared to the later ones. Feeding a first large window at
+    once, and re-scoring the embeddings with `score` against the final statistics when they can be
+    read again, make them comparable. Memory does not depend on the number of embeddings.
+
+    Metrics:
+        euclidean: Distance to the running mean, the centroid heuristic of the outlier detector.
+        mahalanobis: Distance to the running mean in the metric of the running covariance, shrunk
+            towards a multiple of the identity by `shrinkage` to stay invertible with few samples.
+            The precision matrix is recomputed on every batch, in O(dim^3).
+    """
+
+    METRICS = ("euclidean", "mahalanobis")
+
+    def __init__(self, dim: int, quantile: float = 0.85, metric: str = "euclidean", shrinkage: float = 0.1):
+        if metric not in self.METRICS:
+            raise ValueError(f"Unknown metric {metric}, expected one of {self.METRICS}.")
+        self.metric = metric
+        self.shrinkage = shrinkage
+        self.moments = RunningMoments(dim, covariance=metric == "mahalanobis")
+        self.sketch = P2Quantile(quantile)
+
+    def precision(self) -> Optional[np.ndarray]:
+        """Inverse of the regularized running covariance, None for the `euclidean` metric."""
+        if self.metric != "mahalanobis":
+            return None
+        covariance = self.moments.covariance
+        scale = np.trace(covariance) / covariance.shape[0]
+        regularized = (1 - self.shrinkage) * covariance + self.shrinkage * max(scale, 1e-12) * np.eye(covariance.shape[0])
+        return np.linalg.inv(regularized)
+
+    def score(self, embeddings: np.ndarray, precision: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Scores embeddings against the current statistics, without updating them. For the
+        `mahalanobis` metric, `precision` (see `precision`) avoids inverting the covariance again.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float64)
+        if not len(embeddings):
+            return np.zeros(0)
+        deviations = embeddings - self.moments.mean
+        if self.metric == "mahalanobis":
+            precision = precision if precision is not None else self.precision()
+            return np.sqrt(np.maximum(np.einsum("ij,jk,ik->i", deviations, precision, deviations), 0))
+        return np.linalg.norm(deviations, axis=1)
+
+    def update(self, embeddings: np.ndarray) -> np.ndarray:
+        """Adds a batch of embeddings to the statistics and returns their provisional scores."""
+        embeddings = np.asarray(embeddings, dtype=np.float64)
+        if not len(embeddings):
+            return np.zeros(0)
+        self.moments.update(embeddings)
+        scores = self.score(embeddings)
+        self.sketch.extend(scores)
+        return scores
+
+    @property
+    def threshold(self) -> Optional[float]:
+        """Current estimate of the score above which embeddings are outliers."""
+        return self.sketch.value